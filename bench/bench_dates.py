@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# time Date header parsing for --copy: the dateutil chain on its own
+# against the cached standard library fast path in gmailimap.dateEpoch
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gmailimap
+
+# a spread of Date headers as they appear in real mailboxes, from well formed
+# RFC 5322 to the broken ones that need dateutil's fuzzy matching
+CORPUS = [
+    'Mon, 1 Jan 2018 10:00:00 -0500',
+    'Tue, 02 Jan 2018 17:45:13 +0000',
+    'Wed, 3 Jan 2018 08:01:02 +0100 (CET)',
+    'Thu, 4 Jan 2018 23:59:59 -0800 (PST)',
+    'Fri, 5 Jan 2018 12:00:00 GMT',
+    'Sat, 6 Jan 2018 06:30:00 UT',
+    'Sun, 7 Jan 2018 19:20:21 -0000',
+    '8 Jan 2018 09:10:11 +0900',
+    'Tue, 9 Jan 18 14:15:16 +0530',
+    'Wed, 10 Jan 2018 10:00:00 EST',
+    'Thu, 11 Jan 2018 10:00:00 EDT',
+    'Fri, 12 Jan 2018 10:00:00 PDT',
+    'Sat, 13 Jan 2018 10:00 +0200',
+    'Mon, 15 Jan 2018 10:00:00 +0000 (UTC)',
+    'Tue, 16 Jan 2018 10:00:00 CEST',
+    'Wednesday, 17 January 2018 10:00:00 +0100',
+    '2018-01-18 10:00:00 +0000',
+    '2018-01-19T10:00:00Z',
+    'Sat Jan 20 10:00:00 2018',
+    'Sun, 21 Jan 2018 10:00:00 +0000 GMT',
+    'sent on Mon 22 Jan 2018 at 10:00:00 +0000',
+    '1970-01-01 00:00:00 +0000',
+]
+
+def headers(count, seed):
+    # real mailboxes repeat a few formats (and often identical timestamps
+    # from bulk senders), model that with a skewed choice from the corpus
+    rng = random.Random(seed)
+    weights = [len(CORPUS) - i for i in range(len(CORPUS))]
+    for _ in range(count):
+        header = rng.choices(CORPUS, weights)[0]
+        if rng.random() < 0.5:
+            hour, minute = rng.randint(0, 23), rng.randint(0, 59)
+            header = re.sub(r'\d\d:\d\d', f'{hour:02d}:{minute:02d}', header,
+                            count=1)
+        yield header
+
+def timeIt(label, parse, corpus):
+    start = time.perf_counter()
+    for header in corpus:
+        parse(header)
+    elapsed = time.perf_counter() - start
+    print(f'{label}: {len(corpus) / elapsed:.0f} headers/s '
+          f'({elapsed:.3f}s for {len(corpus)})')
+    return elapsed
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=20000,
+                        help='number of Date headers to parse')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the header mix')
+    args = parser.parse_args()
+    # dateutil warns about zone names it does not know, keep that out of
+    # the timings
+    warnings.simplefilter('ignore')
+    corpus = list(headers(args.count, args.seed))
+    for header in set(corpus):
+        try:
+            fast, slow = gmailimap.dateEpoch(header), gmailimap.dateutilEpoch(
+                header)
+        except ValueError:
+            continue
+        if fast != slow:
+            print(f'differs: {header!r} fast:{fast} dateutil:{slow}')
+    gmailimap.dateEpoch.cache_clear()
+    slow = timeIt('dateutil', gmailimap.dateutilEpoch, corpus)
+    gmailimap.dateEpoch.cache_clear()
+    fast = timeIt('fast path', gmailimap.dateEpoch, corpus)
+    print(f'speedup: {slow / fast:.1f}x')
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# time gmailimap and gmailsmtp against the local fake servers: every
+# operation runs in a fresh process, so its peak RSS is its own, and the
+# servers run in another one, so their work is not counted against it
+
+import argparse
+import contextlib
+import datetime
+import functools
+import imaplib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# in the order they run; append and delete change the account, so they go
+# after the read-only operations
+OPERATIONS = ('list', 'count', 'copy', 'envelopes', 'flags', 'flags-delta',
+              'index', 'search', 'copy-labels', 'backup', 'append', 'delete',
+              'smtp')
+MAILBOX = '[Gmail]/All Mail'
+
+def serveImap(messages, latency, bandwidth, counters, ports):
+    import fakeimap
+    server = fakeimap.makeServer(messages, counters=counters,
+                                 latency=latency, bandwidth=bandwidth)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def serveSmtp(latency, drop_every, counters, ports):
+    import fakesmtp
+    server = fakesmtp.makeServer(counters=counters, latency=latency,
+                                 drop_every=drop_every)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def imapLogin(port, compress=False, esearch=True):
+    # what gmailimap.gmailLogin does, minus TLS and OAuth
+    import gmailimap
+    m = imaplib.IMAP4('127.0.0.1', port)
+    m.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    m.login('bench@example.com', 'bench')
+    status, response = m.capability()
+    if 'OK' == status:
+        m.capabilities = tuple(response[-1].decode('utf-8').upper().split())
+    if not esearch:
+        # as if the server only had plain SEARCH
+        m.capabilities = tuple(c for c in m.capabilities if 'ESEARCH' != c)
+    if compress:
+        assert(gmailimap.enableCompression(m, 0))
+    return m
+
+def smtpLogin(port):
+    import smtplib
+    m = smtplib.SMTP('127.0.0.1', port)
+    m.ehlo()
+    m.docmd('AUTH', 'XOAUTH2 YmVuY2g=')
+    return m
+
+def middleDate(messages):
+    import fakeimap
+    middle = fakeimap.START + datetime.timedelta(
+        seconds=fakeimap.SPAN * (messages // 2) / max(messages, 1))
+    return middle.strftime('%Y-%m-%d')
+
+def runOperation(operation, args, port, workdir):
+    # returns the number of messages the operation got through
+    import gmailimap
+    import gmailsmtp
+    if 'smtp' == operation:
+        login = functools.partial(smtpLogin, port)
+        messages = [{'to': [f'recipient{i}@example.com'],
+                     'subject': f'bench message {i}',
+                     'body': 'the quick brown fox\n' * 100}
+                    for i in range(args.smtpMessages)]
+        (sent, failed, rate) = gmailsmtp.sendBatch(
+            login, 'bench@example.com', messages, sessions=args.workers)
+        return sent
+    copydir = os.path.join(workdir, 'copy')
+    if 'search' == operation:
+        # the full text index of what copy downloaded, no IMAP involved
+        import gmail_search
+        conn = gmail_search.openIndex(os.path.join(workdir, 'search.sqlite'))
+        added = gmail_search.updateIndex(conn, copydir, args.workers)[0]
+        conn.close()
+        return added
+    login = functools.partial(imapLogin, port, args.compress,
+                              not args.noEsearch)
+    m = login()
+    stateFile = os.path.join(workdir, 'state.json')
+    before = gmailimap.searchDate('before', middleDate(args.messages), 0)
+    try:
+        if 'list' == operation:
+            mailboxes = gmailimap.listMailboxes(m, 0)
+            return sum(count for mailbox, count in gmailimap.countMailboxes(
+                m, mailboxes, [], 0, workers=args.workers, login=login))
+        if 'count' == operation:
+            return gmailimap.countMessages(m, MAILBOX, [before], 0)
+        if 'copy' == operation:
+            os.makedirs(copydir, exist_ok=True)
+            os.chdir(copydir)
+            return gmailimap.copyMessages(m, MAILBOX, args.batchSize, 0,
+                                          workers=args.workers, login=login)
+        if 'copy-labels' == operation:
+            # what backing up every label with --copy costs
+            os.makedirs(os.path.join(workdir, 'labels'), exist_ok=True)
+            os.chdir(os.path.join(workdir, 'labels'))
+            return sum(gmailimap.copyMessages(m, mailbox, args.batchSize, 0,
+                                              workers=args.workers,
+                                              login=login)
+                       for mailbox in gmailimap.listMailboxes(m, 0))
+        if 'backup' == operation:
+            os.makedirs(os.path.join(workdir, 'backup'), exist_ok=True)
+            os.chdir(os.path.join(workdir, 'backup'))
+            return gmailimap.backup(m, args.batchSize, 0,
+                                    workers=args.workers, login=login,
+                                    linkDir='labels')[0]
+        if 'envelopes' == operation:
+            with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+                gmailimap.envelopes(m, MAILBOX, args.batchSize, 0)
+            return args.messages
+        if operation in ('flags', 'flags-delta'):
+            with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+                gmailimap.flags(m, MAILBOX, 0, stateFile=stateFile)
+            return args.messages
+        if 'index' == operation:
+            return gmailimap.indexMessages(
+                m, MAILBOX, os.path.join(workdir, 'index.sqlite'),
+                args.batchSize, 0)[0]
+        if 'append' == operation:
+            return gmailimap.appendDirectory(m, 'Restore', copydir, 0,
+                                             workers=args.workers,
+                                             login=login)[0]
+        if 'delete' == operation:
+            with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+                return gmailimap.deleteMessages(m, MAILBOX, [before],
+                                                args.batchSize, 0)[1]
+    finally:
+        gmailimap.gmailLogout(m)
+
+def child(operation, args, port, workdir, results):
+    start = time.perf_counter()
+    message_count = runOperation(operation, args, port, workdir)
+    elapsed = time.perf_counter() - start
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak *= 1 if 'darwin' == sys.platform else 1024
+    results.put((message_count, elapsed, peak))
+
+def measure(context, operation, args, port, workdir, counters):
+    results = context.Queue()
+    before = list(counters)
+    process = context.Process(target=child, args=(operation, args, port,
+                                                  workdir, results))
+    process.start()
+    while True:
+        try:
+            (message_count, elapsed, peak) = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                # the child printed its traceback
+                return {'operation': operation,
+                        'error': f'exit code {process.exitcode}'}
+    process.join()
+    # wire bytes, as the server saw them once the sessions closed
+    time.sleep(0.1)
+    wire = sum(after - prior for after, prior in
+               zip(list(counters)[:2], before[:2]))
+    elapsed = max(elapsed, 1e-6)
+    return {'operation': operation, 'messages': message_count,
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(message_count / elapsed, 1),
+            'bytes': wire, 'bytes_per_second': round(wire / elapsed),
+            'peak_rss': peak}
+
+def startServer(context, target, args):
+    counters = context.Array('Q', 3)
+    ports = context.Queue()
+    process = context.Process(target=target, args=args + (counters, ports),
+                              daemon=True)
+    process.start()
+    return process, ports.get(), counters
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--messages', type=int, default=10000,
+                        help='messages in the fake [Gmail]/All Mail')
+    parser.add_argument('-o', '--operations', default=','.join(OPERATIONS),
+                        help='comma separated operations to time, from '
+                        f'{",".join(OPERATIONS)}')
+    parser.add_argument('--batchSize', type=int, default=500,
+                        help='messages per IMAP command')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='parallel IMAP connections or SMTP sessions')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the fake servers wait before replying')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='bytes per second the fake IMAP server sends '
+                        'per connection')
+    parser.add_argument('--smtpMessages', type=int, default=1000,
+                        help='messages to send for the smtp operation')
+    parser.add_argument('--dropEvery', type=int, default=0,
+                        help='fake SMTP drops the session every n messages')
+    parser.add_argument('--compress', action='store_true',
+                        help='use COMPRESS=DEFLATE on the IMAP connections')
+    parser.add_argument('--noEsearch', action='store_true',
+                        help='search with plain SEARCH, not ESEARCH')
+    parser.add_argument('--json', action='store_true',
+                        help='print JSON lines instead of a table')
+    args = parser.parse_args()
+    operations = args.operations.split(',')
+    for operation in operations:
+        if operation not in OPERATIONS:
+            parser.error(f'unknown operation {operation}')
+    if 'append' in operations and 'copy' not in operations:
+        parser.error('append restores what copy downloaded, time both')
+    if 'search' in operations and 'copy' not in operations:
+        parser.error('search indexes what copy downloaded, time both')
+    operations = [o for o in OPERATIONS if o in operations]
+    context = multiprocessing.get_context('spawn')
+    servers = []
+    with tempfile.TemporaryDirectory() as workdir:
+        if [o for o in operations if 'smtp' != o]:
+            servers.append(startServer(context, serveImap,
+                                       (args.messages, args.latency,
+                                        args.bandwidth)))
+        if 'smtp' in operations:
+            servers.append(startServer(context, serveSmtp,
+                                       (args.latency, args.dropEvery)))
+        for operation in operations:
+            (process, port, counters) = servers[-1 if 'smtp' == operation
+                                                else 0]
+            result = measure(context, operation, args, port, workdir,
+                             counters)
+            if args.json:
+                print(json.dumps(result, sort_keys=True))
+            elif 'error' in result:
+                print(f'{operation:12}failed, {result["error"]}')
+            else:
+                print(f'{operation:12}{result["messages"]:9} msgs '
+                      f'{result["seconds"]:8.2f}s '
+                      f'{result["messages_per_second"]:10.1f} msgs/s '
+                      f'{result["bytes"] / 1e6:9.2f} MB '
+                      f'{result["bytes_per_second"] / 1e6:8.2f} MB/s '
+                      f'peak RSS {result["peak_rss"] / 1e6:6.1f} MB')
+            sys.stdout.flush()
+        for (process, port, counters) in servers:
+            process.terminate()
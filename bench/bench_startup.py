@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# guard the startup cost of gmailcli.py: time each subcommand's --help with
+# -X importtime and fail when a heavy module is imported at startup again or
+# the import time goes over budget
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GMAILCLI = os.path.join(TOP, 'gmailcli.py')
+COMMANDS = ('imap', 'smtp', 'send', 'token', 'pack', 'search')
+# modules that only specific code paths need
+HEAVY = ('dateutil', 'google', 'googleapiclient', 'google_auth_oauthlib',
+         'httplib2', 'sqlite3')
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$')
+
+def importTimes(args):
+    # returns {module: cumulative microseconds} for top level imports
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            capture_output=True, text=True, cwd=TOP)
+    modules = {}
+    top_level = {}
+    for line in result.stderr.splitlines():
+        mo = IMPORT_LINE.match(line)
+        if mo is None:
+            continue
+        modules[mo.group(4)] = int(mo.group(2))
+        if 1 == len(mo.group(3)):
+            top_level[mo.group(4)] = int(mo.group(2))
+    return modules, top_level
+
+def wallTime(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, capture_output=True, cwd=TOP)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='runs per command for the wall clock median')
+    parser.add_argument('--budget', type=float, default=100,
+                        help='most milliseconds of imports per command')
+    args = parser.parse_args()
+    baseline, baseline_top = importTimes(['-c', 'pass'])
+    baseline_wall = wallTime(['-c', 'pass'], args.repeat)
+    print(f'python: {baseline_wall * 1000:.1f}ms')
+    failed = False
+    for command in COMMANDS:
+        cli_args = [GMAILCLI, command, '--help']
+        modules, top_level = importTimes(cli_args)
+        import_ms = sum(cumulative for module, cumulative in top_level.items()
+                        if module not in baseline_top) / 1000
+        wall = wallTime(cli_args, args.repeat)
+        heavy = sorted(module for module in modules
+                       if module.split('.')[0] in HEAVY)
+        print(f'{command}: imports:{import_ms:.1f}ms '
+              f'wall:{wall * 1000:.1f}ms '
+              f'(+{(wall - baseline_wall) * 1000:.1f}ms over python)')
+        if heavy:
+            failed = True
+            print(f'{command}: imported at startup: {", ".join(heavy[:5])}')
+        if import_ms > args.budget:
+            failed = True
+            print(f'{command}: over the {args.budget:.0f}ms import budget')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+
+# a local stand-in for imap.gmail.com, good enough to benchmark gmailimap:
+# plain text IMAP4rev1 with the Gmail extensions the tools use (X-GM-MSGID,
+# X-GM-THRID, X-GM-LABELS), UIDPLUS, CONDSTORE, ENABLE, COMPRESS=DEFLATE
+# and partial fetches
+#
+# messages are synthesized from their key (the UID in [Gmail]/All Mail), so
+# a million message account costs a few arrays, not a million messages
+
+import argparse
+import array
+import base64
+import bisect
+import datetime
+import math
+import random
+import re
+import socketserver
+import statistics
+import threading
+import time
+import zlib
+
+START = datetime.datetime(2010, 1, 1, tzinfo=datetime.timezone.utc)
+SPAN = 10 * 365 * 24 * 3600
+UIDVALIDITY = 7
+LABELS = 20
+CAPABILITIES = ('IMAP4rev1 UIDPLUS CONDSTORE ENABLE ESEARCH X-GM-EXT-1 '
+                'LITERAL+ COMPRESS=DEFLATE AUTH=XOAUTH2')
+# sizes are log-normal around a typical mail size, with a long tail of
+# messages with attachments
+MEDIAN_SIZE = 6000
+SIZE_SIGMA = 1.3
+MAX_SIZE = 8 * 1024 * 1024
+# bodies start with text made of words of a made up language, which
+# deflates about as well as real mail does; past TEXT_SIZE bytes they go on
+# as a base64 attachment, which hardly deflates at all
+TEXT_SIZE = 16 * 1024
+
+def makeFiller():
+    rng = random.Random(7)
+    words = [''.join(rng.choice('etaoinshrdlucmfwypvbgk')
+                     for _ in range(rng.randint(2, 10))) for _ in range(3000)]
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    lines = []
+    while sum(map(len, lines)) < 256 * 1024:
+        lines.append(' '.join(rng.choices(words, weights, k=12)) + '\r\n')
+    text = ''.join(lines).encode('ascii')
+    attachment = base64.encodebytes(rng.randbytes(192 * 1024)).replace(
+        b'\n', b'\r\n')
+    return text, attachment
+
+(TEXT, ATTACHMENT) = makeFiller()
+NORMAL = statistics.NormalDist()
+ITEM = re.compile(r'BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[A-Z0-9.\-]+',
+                  re.IGNORECASE)
+SEARCH_RETURN = re.compile(r'\s*RETURN\s*\(([^)]*)\)\s*', re.IGNORECASE)
+SEARCH_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|([^\s()"]+)')
+
+def uniform(key, salt):
+    return ((key * 2654435761 + salt * 40503) % 4294967291) / 4294967291
+
+def messageSize(key):
+    u = min(max(uniform(key, 1), 1e-9), 1 - 1e-9)
+    size = MEDIAN_SIZE * math.exp(SIZE_SIGMA * NORMAL.inv_cdf(u))
+    return int(min(max(size, 600), MAX_SIZE))
+
+def quote(s):
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def parseUidSet(uid_set, largest):
+    ranges = []
+    for part in uid_set.split(','):
+        lo, _, hi = part.partition(':')
+        lo = largest if '*' == lo else int(lo)
+        hi = lo if not hi else (largest if '*' == hi else int(hi))
+        ranges.append((min(lo, hi), max(lo, hi)))
+    return ranges
+
+def formatUidSet(uids):
+    # ascending uids -> 1:3,7,9:12
+    parts = []
+    first = last = None
+    for uid in uids:
+        if last is not None and uid == last + 1:
+            last = uid
+            continue
+        if last is not None:
+            parts.append(str(first) if first == last else f'{first}:{last}')
+        first = last = uid
+    if last is not None:
+        parts.append(str(first) if first == last else f'{first}:{last}')
+    return ','.join(parts)
+
+class Account:
+    def __init__(self, messages):
+        self.lock = threading.RLock()
+        self.total = messages
+        self.next_key = messages + 1
+        self.step = SPAN / max(messages, 1)
+        self.appended = {}
+        self.dates = {}
+        self.labels = {}
+        self.modseq = 1
+        self.mailboxes = {}
+        keys = range(1, messages + 1)
+        self.addMailbox('[Gmail]/All Mail', keys)
+        self.addMailbox('INBOX', [k for k in keys if 0 == k % 10])
+        for label in range(LABELS):
+            self.addMailbox(f'label{label}', [k for k in keys
+                                              if 0 == k % 3 and
+                                              label == k % LABELS])
+        self.addMailbox('Restore', [])
+
+    def addMailbox(self, name, keys):
+        self.mailboxes[name] = Mailbox(name, keys)
+
+    def keyDate(self, key):
+        if key in self.dates:
+            return self.dates[key]
+        return START + datetime.timedelta(seconds=int(key * self.step))
+
+    def keyLabels(self, key):
+        if key in self.labels:
+            return self.labels[key]
+        labels = []
+        if 0 == key % 10:
+            labels.append('\\Inbox')
+        if 0 == key % 3:
+            labels.append(f'label{key % LABELS}')
+        return labels
+
+    def headers(self, key):
+        if key in self.appended:
+            return self.appended[key].split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+        date = self.keyDate(key).strftime('%a, %d %b %Y %H:%M:%S +0000')
+        return (f'Date: {date}\r\n'
+                f'From: Sender {key % 500} <sender{key % 500}@example.com>\r\n'
+                f'To: Recipient <recipient@example.com>\r\n'
+                f'Subject: message {key} about topic{key % 97}\r\n'
+                f'Message-ID: <{key}@example.com>\r\n'
+                f'\r\n').encode('ascii')
+
+    def message(self, key):
+        if key in self.appended:
+            return self.appended[key]
+        head = self.headers(key)
+        size = max(messageSize(key), len(head) + 2) - len(head)
+        offset = key * 7919 % len(TEXT)
+        text = (TEXT[offset:] + TEXT[:offset])[:min(size, TEXT_SIZE)]
+        size -= len(text)
+        attachment = ATTACHMENT * (size // len(ATTACHMENT) + 1)
+        return head + text + attachment[:size]
+
+    def size(self, key):
+        if key in self.appended:
+            return len(self.appended[key])
+        return max(messageSize(key), len(self.headers(key)) + 2)
+
+    def envelope(self, key):
+        date = self.keyDate(key).strftime('%a, %d %b %Y %H:%M:%S +0000')
+        sender = (f'(({quote(f"Sender {key % 500}")} NIL '
+                  f'{quote(f"sender{key % 500}")} "example.com"))')
+        subject = f'message {key} about topic{key % 97}'
+        return (f'({quote(date)} {quote(subject)} {sender} {sender} {sender} '
+                f'(("Recipient" NIL "recipient" "example.com")) NIL NIL NIL '
+                f'{quote(f"<{key}@example.com>")})')
+
+class Mailbox:
+    def __init__(self, name, keys):
+        self.name = name
+        self.uids = array.array('I', range(1, len(keys) + 1))
+        self.keys = array.array('I', keys)
+        self.uidnext = len(keys) + 1
+        self.flags = {}
+        self.modseqs = {}
+
+    def defaultFlags(self, key):
+        return ['\\Seen'] if key % 4 else []
+
+    def uidFlags(self, uid, key):
+        return self.flags.get(uid, self.defaultFlags(key))
+
+    def indexes(self, uid_set):
+        # positions of the UIDs in uid_set, without materializing ranges
+        largest = self.uids[-1] if self.uids else 0
+        for lo, hi in parseUidSet(uid_set, largest):
+            start = bisect.bisect_left(self.uids, lo)
+            end = bisect.bisect_right(self.uids, hi)
+            yield from range(start, end)
+
+class Handler(socketserver.StreamRequestHandler):
+    wbufsize = 256 * 1024
+    account = None
+    counters = None
+    latency = 0
+    bandwidth = 0
+
+    def write(self, data):
+        if str == type(data):
+            data = data.encode('utf-8')
+        if self.deflate is not None:
+            data = self.deflate.compress(data)
+        self.bytes_out += len(data)
+        self.wfile.write(data)
+        if self.bandwidth:
+            # stand in for a slow or metered link
+            time.sleep(len(data) / self.bandwidth)
+
+    def fill(self):
+        data = self.rfile.read1(65536)
+        self.bytes_in += len(data)
+        self.buffer += self.inflate.decompress(data)
+        return data
+
+    def readLine(self):
+        if self.inflate is None:
+            line = self.rfile.readline()
+            self.bytes_in += len(line)
+            return line
+        while b'\n' not in self.buffer and self.fill():
+            pass
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    def readBytes(self, size):
+        if self.inflate is None:
+            data = self.rfile.read(size)
+            self.bytes_in += len(data)
+            return data
+        while len(self.buffer) < size and self.fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def flush(self):
+        if self.deflate is not None:
+            data = self.deflate.flush(zlib.Z_SYNC_FLUSH)
+            self.bytes_out += len(data)
+            self.wfile.write(data)
+            if self.bandwidth:
+                time.sleep(len(data) / self.bandwidth)
+        self.wfile.flush()
+
+    def handle(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.deflate = None
+        self.inflate = None
+        self.buffer = bytearray()
+        self.mailbox = None
+        self.readonly = True
+        self.condstore = False
+        self.write(f'* OK [CAPABILITY {CAPABILITIES}] fake Gmail ready\r\n')
+        self.flush()
+        try:
+            while self.command():
+                self.flush()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            if self.counters is not None:
+                with self.counters.get_lock():
+                    self.counters[0] += self.bytes_in
+                    self.counters[1] += self.bytes_out
+                    self.counters[2] += 1
+
+    def command(self):
+        line = self.readLine()
+        if not line:
+            return False
+        line = line.decode('utf-8').rstrip('\r\n')
+        literal = None
+        mo = re.search(r'\{(\d+)(\+?)\}$', line)
+        if mo:
+            if not mo.group(2):
+                self.write('+ go ahead\r\n')
+                self.flush()
+            literal = self.readBytes(int(mo.group(1)))
+            line = line[:mo.start()] + self.readLine().decode(
+                'utf-8').rstrip('\r\n')
+        (tag, _, rest) = line.partition(' ')
+        (name, _, args) = rest.partition(' ')
+        name = name.upper()
+        if 'UID' == name:
+            (sub, _, args) = args.partition(' ')
+            name = f'UID {sub.upper()}'
+        method = getattr(self, 'do_' + name.replace(' ', '_'), None)
+        if method is None:
+            self.write(f'{tag} BAD unknown command {name}\r\n')
+            return True
+        with self.account.lock:
+            result = method(tag, args, literal)
+        if self.latency:
+            # stand in for the round trip to Google
+            time.sleep(self.latency)
+        if result is False:
+            return False
+        if result is True:
+            return True # already answered
+        self.write(f'{tag} {result or "OK done"}\r\n')
+        return True
+
+    def do_CAPABILITY(self, tag, args, literal):
+        self.write(f'* CAPABILITY {CAPABILITIES}\r\n')
+
+    def do_NOOP(self, tag, args, literal):
+        pass
+
+    def do_LOGIN(self, tag, args, literal):
+        pass
+
+    def do_AUTHENTICATE(self, tag, args, literal):
+        self.write('+ \r\n')
+        self.flush()
+        self.readLine()
+
+    def do_ENABLE(self, tag, args, literal):
+        enabled = [e for e in args.upper().split() if 'CONDSTORE' == e]
+        self.condstore = self.condstore or bool(enabled)
+        self.write(f'* ENABLED {" ".join(enabled)}\r\n')
+
+    def do_COMPRESS(self, tag, args, literal):
+        if 'DEFLATE' != args.upper() or self.deflate is not None:
+            return 'NO [COMPRESSIONACTIVE] only one DEFLATE per session'
+        # everything after the tagged response is compressed, both ways;
+        # level 1 keeps the fake from being the bottleneck, and deflates
+        # mail nearly as well as the default level
+        self.write(f'{tag} OK DEFLATE active\r\n')
+        self.flush()
+        self.deflate = zlib.compressobj(1, zlib.DEFLATED, -15)
+        self.inflate = zlib.decompressobj(-15)
+        return True
+
+    def do_LOGOUT(self, tag, args, literal):
+        self.write('* BYE fake Gmail signing off\r\n')
+        self.write(f'{tag} OK bye\r\n')
+        self.flush()
+        return False
+
+    def do_LIST(self, tag, args, literal):
+        self.write('* LIST (\\HasChildren \\Noselect) "/" "[Gmail]"\r\n')
+        for name in self.account.mailboxes:
+            # RFC 6154 special-use, as Gmail sends it
+            flags = '\\All \\HasNoChildren' if 'All Mail' in name else \
+                '\\HasNoChildren'
+            self.write(f'* LIST ({flags}) "/" {quote(name)}\r\n')
+
+    def mailboxArg(self, args):
+        mo = SEARCH_TOKEN.match(args)
+        name = mo.group(1) if mo.group(1) is not None else mo.group(2)
+        return self.account.mailboxes.get(name), args[mo.end():]
+
+    def select(self, tag, args, readonly):
+        (mailbox, rest) = self.mailboxArg(args)
+        if mailbox is None:
+            self.mailbox = None
+            return 'NO no such mailbox'
+        self.mailbox = mailbox
+        self.readonly = readonly
+        if 'CONDSTORE' in rest.upper():
+            self.condstore = True
+        self.write('* FLAGS (\\Answered \\Flagged \\Draft \\Deleted '
+                   '\\Seen)\r\n'
+                   f'* {len(mailbox.uids)} EXISTS\r\n'
+                   '* 0 RECENT\r\n'
+                   f'* OK [UIDVALIDITY {UIDVALIDITY}] UIDs valid\r\n'
+                   f'* OK [UIDNEXT {mailbox.uidnext}] predicted next UID\r\n'
+                   f'* OK [HIGHESTMODSEQ {self.account.modseq}] modseq\r\n')
+        return f'OK [{"READ-ONLY" if readonly else "READ-WRITE"}] selected'
+
+    def do_SELECT(self, tag, args, literal):
+        return self.select(tag, args, False)
+
+    def do_EXAMINE(self, tag, args, literal):
+        return self.select(tag, args, True)
+
+    def do_CLOSE(self, tag, args, literal):
+        if self.mailbox is not None and not self.readonly:
+            self.expunge(None)
+        self.mailbox = None
+
+    def do_UNSELECT(self, tag, args, literal):
+        self.mailbox = None
+
+    def do_STATUS(self, tag, args, literal):
+        (mailbox, rest) = self.mailboxArg(args)
+        if mailbox is None:
+            return 'NO no such mailbox'
+        unseen = sum(1 for uid, key in zip(mailbox.uids, mailbox.keys)
+                     if '\\Seen' not in mailbox.uidFlags(uid, key))
+        self.write(f'* STATUS {quote(mailbox.name)} (MESSAGES '
+                   f'{len(mailbox.uids)} UNSEEN {unseen} UIDNEXT '
+                   f'{mailbox.uidnext})\r\n')
+
+    def do_APPEND(self, tag, args, literal):
+        (mailbox, rest) = self.mailboxArg(args)
+        if mailbox is None or literal is None:
+            return 'NO [TRYCREATE] no such mailbox'
+        key = self.account.next_key
+        self.account.next_key += 1
+        self.account.appended[key] = literal
+        mo = re.search(r'"(\s?\d{1,2}-\w{3}-\d{4} [\d:]{8} [+-]\d{4})"', rest)
+        if mo:
+            self.account.dates[key] = datetime.datetime.strptime(
+                mo.group(1).strip(), '%d-%b-%Y %H:%M:%S %z')
+        uid = mailbox.uidnext
+        mailbox.uidnext += 1
+        mailbox.uids.append(uid)
+        mailbox.keys.append(key)
+        self.account.modseq += 1
+        mailbox.modseqs[uid] = self.account.modseq
+        return f'OK [APPENDUID {UIDVALIDITY} {uid}] appended'
+
+    def matches(self, criteria):
+        # AND of the criteria gmailimap sends; strings match substrings of
+        # the synthesized headers, like Gmail does for whole words
+        account = self.account
+        tests = []
+        tokens = [mo.group(1) if mo.group(1) is not None else mo.group(2)
+                  for mo in SEARCH_TOKEN.finditer(criteria)]
+        i = 0
+        while i < len(tokens):
+            token = tokens[i].upper()
+            if 'ALL' == token:
+                i += 1
+                continue
+            value = tokens[i + 1] if i + 1 < len(tokens) else ''
+            i += 2
+            if token in ('BEFORE', 'SINCE', 'ON'):
+                day = datetime.datetime.strptime(value, '%d-%b-%Y').date()
+                test = {'BEFORE': lambda d, day=day: d < day,
+                        'SINCE': lambda d, day=day: d >= day,
+                        'ON': lambda d, day=day: d == day}[token]
+                tests.append(lambda uid, key, test=test:
+                             test(account.keyDate(key).date()))
+            elif 'UID' == token:
+                ranges = parseUidSet(value, 2 ** 32 - 1)
+                tests.append(lambda uid, key, ranges=ranges:
+                             any(lo <= uid <= hi for lo, hi in ranges))
+            elif token in ('FROM', 'TO', 'CC', 'BCC', 'SUBJECT', 'X-GM-RAW'):
+                value = value.lower()
+                tests.append(lambda uid, key, value=value:
+                             value in account.headers(key).decode().lower())
+            else:
+                i -= 1
+        return lambda uid, key: all(test(uid, key) for test in tests)
+
+    def search(self, args):
+        match = self.matches(args)
+        mailbox = self.mailbox
+        if not args.strip() or 'ALL' == args.strip().upper():
+            return range(len(mailbox.uids))
+        mo = re.fullmatch(r'UID (\S+)', args.strip(), re.IGNORECASE)
+        if mo:
+            return list(mailbox.indexes(mo.group(1)))
+        return [i for i, (uid, key) in enumerate(zip(mailbox.uids,
+                                                      mailbox.keys))
+                if match(uid, key)]
+
+    def do_SEARCH(self, tag, args, literal):
+        if self.mailbox is None:
+            return 'BAD no mailbox selected'
+        found = self.search(args)
+        self.write('* SEARCH' + ''.join(f' {i + 1}' for i in found) + '\r\n')
+
+    def do_UID_SEARCH(self, tag, args, literal):
+        if self.mailbox is None:
+            return 'BAD no mailbox selected'
+        uids = self.mailbox.uids
+        mo = SEARCH_RETURN.match(args)
+        if mo:
+            args = args[mo.end():]
+        found = self.search(args)
+        if mo is None:
+            self.write('* SEARCH' + ''.join(f' {uids[i]}' for i in found) +
+                       '\r\n')
+            return
+        # ESEARCH (RFC 4731); uids ascend with the index, no sort needed
+        returns = mo.group(1).upper().split() or ['ALL']
+        items = []
+        if found:
+            if 'MIN' in returns:
+                items.append(f'MIN {uids[found[0]]}')
+            if 'MAX' in returns:
+                items.append(f'MAX {uids[found[-1]]}')
+        if 'COUNT' in returns:
+            items.append(f'COUNT {len(found)}')
+        if found and 'ALL' in returns:
+            items.append('ALL ' + formatUidSet(uids[i] for i in found))
+        self.write(f'* ESEARCH (TAG "{tag}") UID' +
+                   ''.join(f' {item}' for item in items) + '\r\n')
+
+    def do_UID_FETCH(self, tag, args, literal):
+        mailbox = self.mailbox
+        if mailbox is None:
+            return 'BAD no mailbox selected'
+        (uid_set, _, items) = args.partition(' ')
+        changedsince = None
+        mo = re.search(r'\(CHANGEDSINCE (\d+)[^)]*\)\s*$', items)
+        if mo:
+            changedsince = int(mo.group(1))
+            items = items[:mo.start()]
+        wanted = ITEM.findall(items)
+        wanted_upper = [item.upper() for item in wanted]
+        modseq = self.condstore or changedsince is not None
+        account = self.account
+        for i in mailbox.indexes(uid_set):
+            uid = mailbox.uids[i]
+            key = mailbox.keys[i]
+            uid_modseq = mailbox.modseqs.get(uid, 1)
+            if changedsince is not None and uid_modseq <= changedsince:
+                continue
+            out = [f'* {i + 1} FETCH (UID {uid}'.encode('ascii')]
+            for item, upper in zip(wanted, wanted_upper):
+                out.append(self.fetchItem(account, mailbox, uid, key, item,
+                                          upper))
+            if modseq and 'MODSEQ' not in wanted_upper:
+                out.append(f' MODSEQ ({uid_modseq})'.encode('ascii'))
+            out.append(b')\r\n')
+            self.write(b''.join(out))
+
+    def fetchItem(self, account, mailbox, uid, key, item, upper):
+        if 'UID' == upper:
+            return b''
+        if 'FLAGS' == upper:
+            return f' FLAGS ({" ".join(mailbox.uidFlags(uid, key))})'.encode()
+        if 'MODSEQ' == upper:
+            return f' MODSEQ ({mailbox.modseqs.get(uid, 1)})'.encode()
+        if 'X-GM-MSGID' == upper:
+            return f' X-GM-MSGID {1500000000000000000 + key}'.encode()
+        if 'X-GM-THRID' == upper:
+            return f' X-GM-THRID {1500000000000000000 + key // 3}'.encode()
+        if 'X-GM-LABELS' == upper:
+            labels = ' '.join(quote(l) for l in account.keyLabels(key))
+            return f' X-GM-LABELS ({labels})'.encode()
+        if 'INTERNALDATE' == upper:
+            date = account.keyDate(key)
+            return (f' INTERNALDATE "{date.day:2d}-'
+                    f'{date.strftime("%b-%Y %H:%M:%S")} +0000"').encode()
+        if 'RFC822.SIZE' == upper:
+            return f' RFC822.SIZE {account.size(key)}'.encode()
+        if 'ENVELOPE' == upper:
+            return f' ENVELOPE {account.envelope(key)}'.encode()
+        if upper in ('RFC822', 'BODY[]', 'BODY.PEEK[]'):
+            data = account.message(key)
+            name = 'RFC822' if 'RFC822' == upper else 'BODY[]'
+            return f' {name} {{{len(data)}}}\r\n'.encode() + data
+        mo = re.fullmatch(r'BODY(?:\.PEEK)?\[\]<(\d+)\.(\d+)>', upper)
+        if mo:
+            offset, length = int(mo.group(1)), int(mo.group(2))
+            data = account.message(key)[offset:offset + length]
+            return f' BODY[]<{offset}> {{{len(data)}}}\r\n'.encode() + data
+        mo = re.fullmatch(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]',
+                          item, re.IGNORECASE)
+        if mo:
+            fields = mo.group(1).upper().split()
+            head = account.message(key).split(b'\r\n\r\n', 1)[0]
+            data = b''.join(line + b'\r\n' for line in head.split(b'\r\n')
+                            if line.split(b':', 1)[0].upper().decode()
+                            in fields) + b'\r\n'
+            return (f' BODY[HEADER.FIELDS ({mo.group(1)})] '
+                    f'{{{len(data)}}}\r\n').encode() + data
+        return b''
+
+    def do_UID_STORE(self, tag, args, literal):
+        mailbox = self.mailbox
+        if mailbox is None or self.readonly:
+            return 'NO mailbox is read-only'
+        (uid_set, _, rest) = args.partition(' ')
+        (action, _, flag_list) = rest.partition(' ')
+        action = action.upper()
+        flag_set = set(flag_list.strip('()').split())
+        self.account.modseq += 1
+        if 'X-GM-LABELS' in action:
+            # labels belong to the message, its MODSEQ changes here only
+            flag_set = set(label.strip('"') for label in flag_set)
+            for i in list(mailbox.indexes(uid_set)):
+                uid = mailbox.uids[i]
+                key = mailbox.keys[i]
+                current = set(self.account.keyLabels(key))
+                if action.startswith('+'):
+                    current |= flag_set
+                elif action.startswith('-'):
+                    current -= flag_set
+                else:
+                    current = flag_set
+                self.account.labels[key] = sorted(current)
+                mailbox.modseqs[uid] = self.account.modseq
+            return
+        for i in list(mailbox.indexes(uid_set)):
+            uid = mailbox.uids[i]
+            key = mailbox.keys[i]
+            current = set(mailbox.uidFlags(uid, key))
+            if action.startswith('+'):
+                current |= flag_set
+            elif action.startswith('-'):
+                current -= flag_set
+            else:
+                current = flag_set
+            mailbox.flags[uid] = sorted(current)
+            mailbox.modseqs[uid] = self.account.modseq
+            if not action.endswith('.SILENT'):
+                self.write(f'* {i + 1} FETCH (UID {uid} FLAGS '
+                           f'({" ".join(mailbox.flags[uid])}))\r\n')
+
+    def expunge(self, uid_set):
+        mailbox = self.mailbox
+        allowed = None
+        if uid_set is not None:
+            allowed = set(mailbox.uids[i] for i in mailbox.indexes(uid_set))
+        keep_uids = array.array('I')
+        keep_keys = array.array('I')
+        expunged = []
+        for uid, key in zip(mailbox.uids, mailbox.keys):
+            if ('\\Deleted' in mailbox.flags.get(uid, ()) and
+                    (allowed is None or uid in allowed)):
+                expunged.append(len(keep_uids) + 1)
+                mailbox.flags.pop(uid, None)
+            else:
+                keep_uids.append(uid)
+                keep_keys.append(key)
+        mailbox.uids = keep_uids
+        mailbox.keys = keep_keys
+        return expunged
+
+    def do_EXPUNGE(self, tag, args, literal):
+        if self.mailbox is None or self.readonly:
+            return 'NO mailbox is read-only'
+        for seq in self.expunge(None):
+            self.write(f'* {seq} EXPUNGE\r\n')
+
+    def do_UID_EXPUNGE(self, tag, args, literal):
+        if self.mailbox is None or self.readonly:
+            return 'NO mailbox is read-only'
+        for seq in self.expunge(args.strip()):
+            self.write(f'* {seq} EXPUNGE\r\n')
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def makeServer(messages, host='127.0.0.1', port=0, counters=None, latency=0,
+               bandwidth=0):
+    handler = type('AccountHandler', (Handler,),
+                   {'account': Account(messages), 'counters': counters,
+                    'latency': latency, 'bandwidth': bandwidth})
+    return Server((host, port), handler)
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--messages', type=int, default=10000,
+                        help='number of messages in [Gmail]/All Mail')
+    parser.add_argument('-p', '--port', type=int, default=1143,
+                        help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each tagged response')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='most bytes per second to send per connection')
+    args = parser.parse_args()
+    server = makeServer(args.messages, port=args.port, latency=args.latency,
+                        bandwidth=args.bandwidth)
+    print(f'fake Gmail IMAP on 127.0.0.1:{server.server_address[1]} '
+          f'with {args.messages} messages')
+    server.serve_forever()
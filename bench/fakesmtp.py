@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# a local stand-in for smtp.gmail.com, good enough to benchmark gmailsmtp:
+# plain text ESMTP that accepts any AUTH, can wait before every reply like a
+# distant server does, and can drop the session after every n-th message
+# like Gmail does when a session has been busy for too long
+
+import argparse
+import socketserver
+import threading
+import time
+
+class Handler(socketserver.StreamRequestHandler):
+    latency = 0
+    drop_every = 0
+    counters = None
+    lock = threading.Lock()
+    messages = [0]
+
+    def reply(self, line):
+        if self.latency:
+            time.sleep(self.latency)
+        data = line.encode('ascii') + b'\r\n'
+        self.bytes_out += len(data)
+        self.wfile.write(data)
+
+    def readLine(self):
+        line = self.rfile.readline()
+        self.bytes_in += len(line)
+        return line
+
+    def handle(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        try:
+            self.session()
+        except ConnectionError:
+            pass
+        finally:
+            if self.counters is not None:
+                with self.counters.get_lock():
+                    self.counters[0] += self.bytes_in
+                    self.counters[1] += self.bytes_out
+                    self.counters[2] += 1
+
+    def session(self):
+        self.reply('220 fake Gmail ESMTP ready')
+        while True:
+            line = self.readLine()
+            if not line:
+                return
+            command = line.decode('utf-8').strip().split(' ')[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250-fake Gmail at your service\r\n'
+                           '250-SIZE 35882577\r\n'
+                           '250-8BITMIME\r\n'
+                           '250-AUTH LOGIN PLAIN XOAUTH2\r\n'
+                           '250 SMTPUTF8')
+            elif 'AUTH' == command:
+                self.reply('235 2.7.0 Accepted')
+            elif 'DATA' == command:
+                self.reply('354 Go ahead')
+                while self.readLine() not in (b'.\r\n', b''):
+                    pass
+                with self.lock:
+                    self.messages[0] += 1
+                    count = self.messages[0]
+                if self.drop_every and 0 == count % self.drop_every:
+                    self.reply('421 4.7.0 Try again later, closing connection')
+                    return
+                self.reply('250 2.0.0 OK')
+            elif 'QUIT' == command:
+                self.reply('221 2.0.0 closing connection')
+                return
+            else:
+                self.reply('250 2.1.0 OK')
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def makeServer(host='127.0.0.1', port=0, counters=None, latency=0,
+               drop_every=0):
+    handler = type('SessionHandler', (Handler,),
+                   {'counters': counters, 'latency': latency,
+                    'drop_every': drop_every, 'lock': threading.Lock(),
+                    'messages': [0]})
+    return Server((host, port), handler)
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=1025,
+                        help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each reply')
+    parser.add_argument('--dropEvery', type=int, default=0,
+                        help='drop the session after every n-th message')
+    args = parser.parse_args()
+    server = makeServer(port=args.port, latency=args.latency,
+                        drop_every=args.dropEvery)
+    print(f'fake Gmail SMTP on 127.0.0.1:{server.server_address[1]}')
+    server.serve_forever()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mailboxes (
+    name TEXT PRIMARY KEY,
+    uidvalidity INTEGER NOT NULL,
+    last_uid INTEGER NOT NULL,
+    highestmodseq INTEGER
+);
+CREATE TABLE IF NOT EXISTS messages (
+    mailbox TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    msgid INTEGER,
+    thrid INTEGER,
+    labels TEXT,
+    internaldate INTEGER,
+    size INTEGER,
+    date TEXT,
+    subject TEXT,
+    from_addrs TEXT,
+    sender_addrs TEXT,
+    reply_to_addrs TEXT,
+    to_addrs TEXT,
+    cc_addrs TEXT,
+    bcc_addrs TEXT,
+    in_reply_to TEXT,
+    message_id TEXT,
+    PRIMARY KEY (mailbox, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_msgid ON messages (msgid);
+CREATE INDEX IF NOT EXISTS messages_thrid ON messages (thrid);
+CREATE INDEX IF NOT EXISTS messages_internaldate
+    ON messages (mailbox, internaldate);
+'''
+
+COLUMNS = ('mailbox', 'uid', 'msgid', 'thrid', 'labels', 'internaldate',
+           'size', 'date', 'subject', 'from_addrs', 'sender_addrs',
+           'reply_to_addrs', 'to_addrs', 'cc_addrs', 'bcc_addrs',
+           'in_reply_to', 'message_id')
+
+# IMAP SEARCH dates ignore the time of day, compare INTERNALDATE the same way
+DATE_CRITERIA = {
+    'before': "date(internaldate, 'unixepoch') < ?",
+    'on': "date(internaldate, 'unixepoch') = ?",
+    'since': "date(internaldate, 'unixepoch') >= ?",
+}
+
+# like IMAP SEARCH, string criteria are case-insensitive substring matches
+STRING_CRITERIA = {
+    'bcc': 'bcc_addrs',
+    'cc': 'cc_addrs',
+    'sender': 'from_addrs',
+    'to': 'to_addrs',
+    'subject': 'subject',
+}
+
+def openIndex(indexFile):
+    conn = sqlite3.connect(indexFile)
+    conn.executescript(SCHEMA)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(mailboxes)')]
+    if 'highestmodseq' not in columns: # an index made by an earlier version
+        with conn:
+            conn.execute('ALTER TABLE mailboxes ADD COLUMN highestmodseq '
+                         'INTEGER')
+    return conn
+
+def mailboxState(conn, mailbox, uidvalidity, debug=0):
+    row = conn.execute('SELECT uidvalidity, last_uid FROM mailboxes '
+                       'WHERE name = ?', (mailbox,)).fetchone()
+    if row is not None and row[0] == uidvalidity:
+        return row[1]
+    if row is not None:
+        print(f'{mailbox}: UIDVALIDITY changed, reindexing')
+    with conn:
+        conn.execute('DELETE FROM messages WHERE mailbox = ?', (mailbox,))
+        conn.execute('INSERT OR REPLACE INTO mailboxes (name, uidvalidity, '
+                     'last_uid) VALUES (?, ?, 0)', (mailbox, uidvalidity))
+    if debug > 0: print(f'{mailbox}: new index')
+    return 0
+
+def addMessages(conn, mailbox, rows, last_uid):
+    with conn:
+        conn.executemany(
+            f'INSERT OR REPLACE INTO messages ({", ".join(COLUMNS)}) '
+            f'VALUES ({", ".join("?" * len(COLUMNS))})', rows)
+        conn.execute('UPDATE mailboxes SET last_uid = ? WHERE name = ?',
+                     (last_uid, mailbox))
+
+def mailboxModseq(conn, mailbox):
+    # the HIGHESTMODSEQ the labels were last brought up to, or None
+    row = conn.execute('SELECT highestmodseq FROM mailboxes WHERE name = ?',
+                       (mailbox,)).fetchone()
+    return None if row is None else row[0]
+
+def updateLabels(conn, mailbox, labels, highestmodseq=None):
+    # labels: (labels JSON, uid) for messages already in the index
+    with conn:
+        conn.executemany('UPDATE messages SET labels = ? '
+                         'WHERE mailbox = ? AND uid = ?',
+                         ((row[0], mailbox, row[1]) for row in labels))
+        if highestmodseq is not None:
+            conn.execute('UPDATE mailboxes SET highestmodseq = ? '
+                         'WHERE name = ?', (highestmodseq, mailbox))
+
+def pruneMessages(conn, mailbox, uids):
+    # drop rows for messages that are no longer in the mailbox; uids only
+    # needs `in`, e.g. gmailimap.UidRanges
+    gone = [row[0] for row in conn.execute(
+        'SELECT uid FROM messages WHERE mailbox = ?', (mailbox,))
+        if row[0] not in uids]
+    with conn:
+        conn.executemany('DELETE FROM messages WHERE mailbox = ? AND uid = ?',
+                         ((mailbox, uid) for uid in gone))
+    return len(gone)
+
+def searchCriteria(args):
+    where = []
+    params = []
+    for name, clause in DATE_CRITERIA.items():
+        if getattr(args, name, None):
+            where.append(clause)
+            params.append(getattr(args, name))
+    for name, column in STRING_CRITERIA.items():
+        if getattr(args, name, None):
+            where.append(f'{column} LIKE ?')
+            params.append(f'%{getattr(args, name)}%')
+    return where, params
+
+def listMailboxes(conn):
+    return [row[0] for row in
+            conn.execute('SELECT name FROM mailboxes ORDER BY name')]
+
+def countMessages(conn, mailbox, where, params):
+    sql = ' AND '.join(['mailbox = ?'] + where)
+    return conn.execute(f'SELECT count(*) FROM messages WHERE {sql}',
+                        [mailbox] + params).fetchone()[0]
+
+if '__main__' == __name__:
+    print('gmail_index called directly')
@@ -1,18 +1,163 @@
 #!/usr/bin/env python3
 
+import contextlib
+import fcntl
 import json
-from google.auth.transport.requests import Request
+import os
+import queue
+import sys
+import threading
+import time
+
+# credentials per token file, shared by every connection in this process
+CREDENTIALS = {}
+CREDENTIALS_LOCK = threading.Lock()
 
 def refreshToken(tokenFile, credentials):
+    from google.auth.transport.requests import Request
     credentials.refresh(Request())
     with open(tokenFile, 'r') as f:
         old_token = json.load(f)
     new_token = old_token
     new_token['token'] = credentials.token
     new_token['expiry'] = f'{credentials.expiry.isoformat()}Z'
-    with open(tokenFile, 'w') as f:
+    # write to the side and rename so readers never see a partial file; the
+    # file holds the refresh token and client secret, so the copy is never
+    # readable by more than the original was
+    mode = os.stat(tokenFile).st_mode & 0o777
+    fd = os.open(f'{tokenFile}.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 0o600)
+    os.fchmod(fd, mode)
+    with open(fd, 'w') as f:
         json.dump(new_token, f, indent=4, sort_keys=True)
         f.write('\n')
+    os.replace(f'{tokenFile}.tmp', tokenFile)
+
+@contextlib.contextmanager
+def tokenLock(tokenFile):
+    with open(f'{tokenFile}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def loadCredentials(tokenFile, debug=0):
+    # the google packages take a while to import, only pay for that when a
+    # token file is actually used
+    from google.oauth2.credentials import Credentials
+    with CREDENTIALS_LOCK:
+        credentials = CREDENTIALS.get(tokenFile)
+        if credentials is None:
+            credentials = Credentials.from_authorized_user_file(tokenFile)
+        if credentials.expired or not credentials.token:
+            with tokenLock(tokenFile):
+                # another process may have refreshed while we waited
+                credentials = Credentials.from_authorized_user_file(tokenFile)
+                if credentials.expired or not credentials.token:
+                    if debug > 0: print('access token expired, refreshing')
+                    refreshToken(tokenFile, credentials)
+        CREDENTIALS[tokenFile] = credentials
+        return credentials
+
+def authString(username, tokenFile, debug=0):
+    credentials = loadCredentials(tokenFile, debug)
+    auth_string = 'user=%s\1auth=Bearer %s\1\1' % (username,
+                                                   credentials.token)
+    if debug > 1: print(auth_string)
+    return auth_string
+
+class SessionPool:
+    # hands out authenticated sessions (IMAP or SMTP) and takes them back
+    # for the next caller; a session that raised is closed, not reused
+    def __init__(self, connect, disconnect, size=1, check=None,
+                 max_idle=60):
+        self.connect = connect
+        self.disconnect = disconnect
+        self.size = size
+        self.check = check
+        self.max_idle = max_idle
+        self.idle = queue.LifoQueue()
+
+    @contextlib.contextmanager
+    def session(self):
+        s = self.get()
+        try:
+            yield s
+        except BaseException:
+            self.discard(s)
+            raise
+        self.put(s)
+
+    def get(self):
+        while True:
+            try:
+                (s, idle_since) = self.idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if (self.check is None or
+                    time.monotonic() - idle_since < self.max_idle):
+                return s
+            try:
+                self.check(s)
+                return s
+            except Exception:
+                self.discard(s)
+
+    def put(self, s):
+        if self.idle.qsize() < self.size:
+            self.idle.put((s, time.monotonic()))
+        else:
+            self.discard(s)
+
+    def discard(self, s):
+        try:
+            self.disconnect(s)
+        except Exception:
+            pass # the session is already broken
+
+    def close(self):
+        while True:
+            try:
+                (s, idle_since) = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(s)
+
+def readBatch(batchFile):
+    # the JSON lines mail merge of gmailsmtp and gmailsend --batch; a line
+    # that is not JSON comes through as its error, so it fails on its own
+    # like a refused message instead of ending the batch
+    f = sys.stdin if '-' == batchFile else open(batchFile, 'r')
+    with f:
+        for line in f:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield ValueError(f'not JSON: {e}')
+
+def checkMessage(message):
+    # the error that keeps a readBatch message from being sent, or None
+    if isinstance(message, Exception):
+        return message
+    if dict != type(message):
+        return ValueError('not a JSON object')
+    missing = [key for key in ('to', 'subject', 'body') if key not in message]
+    if missing:
+        return ValueError(f'missing {", ".join(missing)}')
+    to = message['to']
+    if str != type(to) and not (list == type(to) and to and
+                                all(str == type(a) for a in to)):
+        return TypeError('to is not an address or a list of addresses')
+    for key in ('subject', 'body'):
+        if str != type(message[key]):
+            return TypeError(f'{key} is not a string')
+    attachments = message.get('attachments', [])
+    if list != type(attachments) or not all(str == type(a)
+                                            for a in attachments):
+        return TypeError('attachments is not a list of paths')
+    return None
 
 if '__main__' == __name__:
     print('gmail_lib called directly')
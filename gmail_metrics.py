@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# timings and counters for long runs: how long every IMAP command took, how
+# much time went to parsing, dates and disk writes, and how many messages
+# and bytes went by; shown as a progress line while the run goes and
+# written as JSON lines or a Prometheus textfile at the end
+
+import bisect
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+# upper bounds, in seconds, of the IMAP command latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROGRESS_INTERVAL = 0.5
+PREFIX = 'gmailcli_'
+
+def duration(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}'
+
+def labels(**kwargs):
+    return ','.join(f'{key}="{value}"' for key, value in kwargs.items())
+
+class Metrics:
+    # one per process, shared by every connection and worker thread; while
+    # not enabled, timer and count cost next to nothing
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.show_progress = False
+        self.start = time.monotonic()
+        self.commands = {}
+        self.phases = {}
+        self.counters = {}
+        self.progress_starts = {}
+        self.last_progress = 0
+        self.progress_shown = False
+
+    def observe(self, command, seconds):
+        with self.lock:
+            histogram = self.commands.get(command)
+            if histogram is None:
+                histogram = {'buckets': [0] * (len(BUCKETS) + 1),
+                             'count': 0, 'sum': 0.0}
+                self.commands[command] = histogram
+            histogram['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                (count, total) = self.phases.get(phase, (0, 0.0))
+                self.phases[phase] = (count + 1, total + seconds)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def instrument(self, m):
+        # every imaplib command goes through _simple_command, and every
+        # byte through read, readline and send
+        simple_command = m._simple_command
+        read = m.read
+        readline = m.readline
+        send = m.send
+        def timedCommand(name, *args):
+            command = f'{name} {args[0]}'.upper() if 'UID' == name else name
+            start = time.perf_counter()
+            try:
+                return simple_command(name, *args)
+            finally:
+                self.observe(command, time.perf_counter() - start)
+        def countedRead(size):
+            data = read(size)
+            self.count('imap_received_bytes_total', len(data))
+            return data
+        def countedReadline():
+            line = readline()
+            self.count('imap_received_bytes_total', len(line))
+            return line
+        def countedSend(data):
+            self.count('imap_sent_bytes_total', len(data))
+            return send(data)
+        m._simple_command = timedCommand
+        m.read = countedRead
+        m.readline = countedReadline
+        m.send = countedSend
+        return m
+
+    def progress(self, label, done, total):
+        if not self.show_progress:
+            return
+        now = time.monotonic()
+        start = self.progress_starts.setdefault(label, now)
+        if now - self.last_progress < PROGRESS_INTERVAL and done < total:
+            return
+        self.last_progress = now
+        elapsed = max(now - start, 1e-6)
+        rate = done / elapsed
+        received = self.counters.get('imap_received_bytes_total', 0)
+        eta = duration((total - done) / rate) if rate else '?'
+        line = (f'{label}: {done}/{total} {rate:.1f} msgs/s '
+                f'{received / (now - self.start) / 1e6:.2f} MB/s '
+                f'elapsed {duration(elapsed)} ETA {eta}')
+        sys.stderr.write(f'\r{line:<79}')
+        sys.stderr.flush()
+        self.progress_shown = True
+
+    def progressDone(self):
+        if self.progress_shown:
+            sys.stderr.write('\n')
+            self.progress_shown = False
+
+    def rows(self):
+        with self.lock:
+            rows = [{'metric': 'run_seconds',
+                     'value': round(time.monotonic() - self.start, 6)}]
+            for name, value in sorted(self.counters.items()):
+                rows.append({'metric': name, 'value': value})
+            for phase, (count, total) in sorted(self.phases.items()):
+                rows.append({'metric': 'phase_seconds', 'phase': phase,
+                             'count': count, 'sum': round(total, 6)})
+            for command, histogram in sorted(self.commands.items()):
+                cumulative = 0
+                buckets = {}
+                for le, count in zip(BUCKETS + ('+Inf',),
+                                     histogram['buckets']):
+                    cumulative += count
+                    buckets[str(le)] = cumulative
+                rows.append({'metric': 'imap_command_seconds',
+                             'command': command, 'buckets': buckets,
+                             'count': histogram['count'],
+                             'sum': round(histogram['sum'], 6)})
+        return rows
+
+    def writeJson(self, metricsFile):
+        # one line per metric, appended so runs can be compared over time
+        now = int(time.time())
+        with open(metricsFile, 'a') as f:
+            for row in self.rows():
+                f.write(json.dumps(dict(row, time=now), sort_keys=True))
+                f.write('\n')
+
+    def writePrometheus(self, metricsFile):
+        lines = []
+        for row in self.rows():
+            name = PREFIX + row['metric']
+            if 'phase_seconds' == row['metric']:
+                lines.append(f'{name}_sum{{{labels(phase=row["phase"])}}} '
+                             f'{row["sum"]}')
+                lines.append(f'{name}_count{{{labels(phase=row["phase"])}}} '
+                             f'{row["count"]}')
+            elif 'imap_command_seconds' == row['metric']:
+                command = row['command']
+                for le, count in row['buckets'].items():
+                    lines.append(f'{name}_bucket'
+                                 f'{{{labels(command=command, le=le)}}} '
+                                 f'{count}')
+                lines.append(f'{name}_sum{{{labels(command=command)}}} '
+                             f'{row["sum"]}')
+                lines.append(f'{name}_count{{{labels(command=command)}}} '
+                             f'{row["count"]}')
+            else:
+                kind = 'counter' if name.endswith('_total') else 'gauge'
+                lines.append(f'# TYPE {name} {kind}')
+                lines.append(f'{name} {row["value"]}')
+        for metric, kind in (('phase_seconds', 'summary'),
+                             ('imap_command_seconds', 'histogram')):
+            first = next((i for i, line in enumerate(lines)
+                          if line.startswith(PREFIX + metric)), None)
+            if first is not None:
+                lines.insert(first, f'# TYPE {PREFIX}{metric} {kind}')
+        # the node exporter may read the file at any time, never let it see
+        # a partial one
+        with open(f'{metricsFile}.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{metricsFile}.tmp', metricsFile)
+
+    def write(self, metricsFile):
+        if metricsFile.endswith('.prom'):
+            self.writePrometheus(metricsFile)
+        else:
+            self.writeJson(metricsFile)
+
+METRICS = Metrics()
+
+if '__main__' == __name__:
+    print('gmail_metrics called directly')
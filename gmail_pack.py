@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+# --copy --format pack: messages are appended to a few large pack files
+# instead of one file each, every message compressed on its own so any one
+# of them can be read back without the rest
+#
+# pack-000001.pack, pack-000002.pack, ...  rolled over at --packSize
+# index.idx      entries sorted by X-GM-MSGID, looked up through mmap
+# index.journal  entries written since index.idx was last merged
+# index.lock     flock: the writer merges under LOCK_EX, readers load the
+#                index and journal under LOCK_SH and never change them
+# write.lock     flock: held LOCK_EX by the one writer for as long as it is
+#                open, so two runs never append to the same pack
+#
+# an entry is 32 bytes: X-GM-MSGID, epoch, offset and length in the pack,
+# pack number and compression, big-endian
+
+import argparse
+import contextlib
+import fcntl
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+INDEX = 'index.idx'
+JOURNAL = 'index.journal'
+LOCK = 'index.lock'
+WRITE_LOCK = 'write.lock'
+PACK = 'pack-{:06d}.pack'
+PACK_SIZE = 1024 * 1024 * 1024
+ENTRY = struct.Struct('>QqQIHH')
+MSGID = struct.Struct('>Q')
+CODECS = ('none', 'gzip', 'zstd')
+COPY_SIZE = 1024 * 1024
+
+def compressor(codec):
+    # anything with compress() and flush(), or None
+    if 'gzip' == codec:
+        # a gzip member per message, `gzip -dc` reads a record as is
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if 'zstd' == codec:
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+def decompress(codec, data):
+    if 'gzip' == CODECS[codec]:
+        return zlib.decompress(data, 31)
+    if 'zstd' == CODECS[codec]:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+def readEntries(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'rb') as f:
+        data = f.read()
+    # a journal cut short by a crash ends in part of an entry
+    end = len(data) - len(data) % ENTRY.size
+    return [data[i:i + ENTRY.size] for i in range(0, end, ENTRY.size)]
+
+@contextlib.contextmanager
+def packLock(directory, operation):
+    with open(os.path.join(directory, LOCK), 'a') as f:
+        fcntl.flock(f.fileno(), operation)
+        yield
+
+def mergeJournal(directory):
+    # for PackWriter only, the journal is unlinked afterwards; the first
+    # field is the big-endian X-GM-MSGID, so sorting the raw entries sorts
+    # them by message
+    journal = os.path.join(directory, JOURNAL)
+    with packLock(directory, fcntl.LOCK_EX):
+        if not os.path.exists(journal):
+            return 0
+        added = readEntries(journal)
+        entries = {entry[:MSGID.size]: entry for entry in
+                   readEntries(os.path.join(directory, INDEX)) + added}
+        index = os.path.join(directory, INDEX)
+        with open(f'{index}.tmp', 'wb') as f:
+            for key in sorted(entries):
+                f.write(entries[key])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{index}.tmp', index)
+        os.remove(journal)
+    return len(added)
+
+class PackIndex:
+    def __init__(self, directory):
+        self.map = None
+        self.count = 0
+        filename = os.path.join(directory, INDEX)
+        if os.path.exists(filename) and 0 < os.path.getsize(filename):
+            with open(filename, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.count = len(self.map) // ENTRY.size
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        return ENTRY.unpack_from(self.map, i * ENTRY.size)
+
+    def find(self, message_id):
+        # binary search, touching log2(n) pages of the index
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if MSGID.unpack_from(self.map, mid * ENTRY.size)[0] < message_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            entry = self.entry(lo)
+            if entry[0] == message_id:
+                return entry
+        return None
+
+    def entries(self):
+        for i in range(self.count):
+            yield self.entry(i)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+class RecordWriter:
+    # compresses a message into a spool file as its chunks arrive
+    def __init__(self, spool, codec):
+        self.spool = spool
+        self.compressor = compressor(codec)
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.spool.write(data)
+
+    def finish(self):
+        if self.compressor is not None:
+            self.spool.write(self.compressor.flush())
+        self.spool.seek(0)
+
+class PackWriter:
+    # used by --copy from several worker threads at once
+    def __init__(self, directory='.', codec='none', pack_size=PACK_SIZE):
+        self.directory = directory
+        self.codec = codec
+        self.pack_size = pack_size
+        self.lock = threading.Lock()
+        compressor(codec) # fail now, not after the first batch
+        os.makedirs(directory, exist_ok=True)
+        # each writer appends at the offsets its own pack.tell() gives, a
+        # second one would write entries pointing at the other's records;
+        # BlockingIOError when another run has the directory
+        self.write_lock = open(os.path.join(directory, WRITE_LOCK), 'a')
+        try:
+            fcntl.flock(self.write_lock.fileno(),
+                        fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.write_lock.close()
+            raise
+        mergeJournal(directory)
+        self.index = PackIndex(directory)
+        self.added = set()
+        packs = [int(name[5:11]) for name in os.listdir(directory)
+                 if name.startswith('pack-') and name.endswith('.pack')]
+        self.pack_number = max(packs, default=1)
+        self.pack = open(self.packPath(), 'ab')
+        self.journal = open(os.path.join(directory, JOURNAL), 'ab')
+
+    def packPath(self):
+        return os.path.join(self.directory, PACK.format(self.pack_number))
+
+    def exists(self, message_id):
+        return (message_id in self.added or
+                self.index.find(message_id) is not None)
+
+    def append(self, epoch, message_id, source, length):
+        with self.lock:
+            if self.exists(message_id):
+                return False
+            offset = self.pack.tell()
+            if 0 < offset and self.pack_size < offset + length:
+                self.pack.close()
+                self.pack_number += 1
+                self.pack = open(self.packPath(), 'ab')
+                offset = self.pack.tell()
+            if bytes == type(source):
+                self.pack.write(source)
+            else:
+                shutil.copyfileobj(source, self.pack, COPY_SIZE)
+            # the record has to reach the file before the entry pointing at
+            # it can, or a killed run leaves an entry past the end of the
+            # pack, over bytes the next run appends there
+            self.pack.flush()
+            self.journal.write(ENTRY.pack(message_id, epoch, offset, length,
+                                          self.pack_number,
+                                          CODECS.index(self.codec)))
+            self.added.add(message_id)
+            return True
+
+    def write(self, epoch, message_id, data):
+        message_id = int(message_id)
+        if self.exists(message_id):
+            return False
+        c = compressor(self.codec)
+        if c is not None:
+            data = c.compress(data) + c.flush()
+        return self.append(epoch, message_id, data, len(data))
+
+    @contextlib.contextmanager
+    def open(self, epoch, message_id):
+        # big messages arrive in pieces; spool them so the pack is only
+        # locked while the finished record is copied in
+        with tempfile.TemporaryFile(dir=self.directory) as spool:
+            writer = RecordWriter(spool, self.codec)
+            yield writer
+            writer.finish()
+            length = os.fstat(spool.fileno()).st_size
+            self.append(epoch, int(message_id), spool, length)
+
+    def sync(self):
+        # the pack data has to be down before the entries that point at it
+        with self.lock:
+            self.pack.flush()
+            os.fsync(self.pack.fileno())
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def close(self):
+        self.sync()
+        self.pack.close()
+        self.journal.close()
+        self.index.close()
+        merged = mergeJournal(self.directory)
+        self.write_lock.close()
+        return merged
+
+class PackReader:
+    def __init__(self, directory='.'):
+        # a --copy may be writing to the directory: read the journal as it
+        # is, next to the index, and leave both alone
+        self.directory = directory
+        with packLock(directory, fcntl.LOCK_SH):
+            self.index = PackIndex(directory)
+            self.journal = {}
+            for entry in readEntries(os.path.join(directory, JOURNAL)):
+                entry = ENTRY.unpack(entry)
+                self.journal[entry[0]] = entry
+        self.packs = {}
+
+    def read(self, entry):
+        (message_id, epoch, offset, length, pack_number, codec) = entry
+        f = self.packs.get(pack_number)
+        if f is None:
+            f = open(os.path.join(self.directory, PACK.format(pack_number)),
+                     'rb')
+            self.packs[pack_number] = f
+        f.seek(offset)
+        return decompress(codec, f.read(length))
+
+    def find(self, message_id):
+        entry = self.journal.get(message_id)
+        return entry if entry is not None else self.index.find(message_id)
+
+    def get(self, message_id):
+        entry = self.find(int(message_id))
+        return None if entry is None else self.read(entry)
+
+    def entries(self):
+        # sorted by X-GM-MSGID, journal entries included
+        entries = {entry[0]: entry for entry in self.index.entries()}
+        entries.update(self.journal)
+        for message_id in sorted(entries):
+            yield entries[message_id]
+
+    def messages(self):
+        # in pack order, which reads the packs front to back
+        for entry in sorted(self.entries(), key=lambda e: (e[4], e[2])):
+            yield entry[0], entry[1], self.read(entry)
+
+    def close(self):
+        for f in self.packs.values():
+            f.close()
+        self.index.close()
+
+def exportMaildir(reader, directory, debug=0):
+    # the same <epoch>.<X-GM-MSGID>.gmail names as --copy, so --appendDir
+    # and existing backups see the same messages
+    for sub in ('cur', 'new', 'tmp'):
+        os.makedirs(os.path.join(directory, sub), exist_ok=True)
+    message_count = 0
+    for message_id, epoch, data in reader.messages():
+        name = f'{epoch}.{message_id}.gmail'
+        tmp = os.path.join(directory, 'tmp', name)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(directory, 'cur', name))
+        message_count += 1
+        if debug > 0: print(name)
+    return message_count
+
+def exportMbox(reader, filename, debug=0):
+    # mboxrd: every From_ line in a body, quoted or not, gains a '>'
+    message_count = 0
+    with open(filename, 'ab') as f:
+        for message_id, epoch, data in reader.messages():
+            date = time.asctime(time.gmtime(epoch)).encode('ascii')
+            f.write(b'From MAILER-DAEMON ' + date + b'\n')
+            for line in data.replace(b'\r\n', b'\n').split(b'\n'):
+                if line.lstrip(b'>').startswith(b'From '):
+                    line = b'>' + line
+                f.write(line + b'\n')
+            f.write(b'\n')
+            message_count += 1
+            if debug > 0: print(message_id)
+    return message_count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--debug', action='count', default=0,
+                        help='increase debug verbosity')
+    parser.add_argument('-p', '--packDir', default='.',
+                        help='directory written by --copy --format pack')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--list', action='store_true',
+                       help='list X-GM-MSGID, epoch, pack, offset and length')
+    group.add_argument('--get',
+                       help='write the message with this X-GM-MSGID to stdout')
+    group.add_argument('--maildir',
+                       help='export every message to this Maildir')
+    group.add_argument('--mbox',
+                       help='append every message to this mbox file')
+    args = parser.parse_args(argv)
+    reader = PackReader(args.packDir)
+    if args.list:
+        for (message_id, epoch, offset, length, pack_number,
+             codec) in reader.entries():
+            print(f'{message_id} {epoch} {PACK.format(pack_number)} '
+                  f'{offset} {length} {CODECS[codec]}')
+    if args.get:
+        data = reader.get(args.get)
+        if data is None:
+            print(f'{args.get}: not found', file=sys.stderr)
+            sys.exit(1)
+        sys.stdout.buffer.write(data)
+    if args.maildir:
+        message_count = exportMaildir(reader, args.maildir, args.debug)
+        print(f'{args.maildir}:{message_count}')
+    if args.mbox:
+        message_count = exportMbox(reader, args.mbox, args.debug)
+        print(f'{args.mbox}:{message_count}')
+    reader.close()
+
+if '__main__' == __name__:
+    main()
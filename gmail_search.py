@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# full text search over the files --copy wrote: an SQLite FTS5 index of the
+# sender, recipients, subject and text body of every message, brought up to
+# date by parsing only the files it has not seen yet
+#
+# the index is contentless, it holds the terms but not the bodies, so it
+# stays a fraction of the size of the messages; the messages table keeps
+# what is shown for a match
+
+import argparse
+import datetime
+import email
+import email.header
+import email.utils
+import gmailimap
+import html
+import os
+import re
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL UNIQUE,
+    epoch INTEGER NOT NULL,
+    sender TEXT,
+    subject TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_epoch ON messages (epoch);
+CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5(
+    sender, recipients, subject, body,
+    content='', tokenize='unicode61 remove_diacritics 2'
+);
+'''
+
+# query field -> FTS5 column
+FIELDS = {
+    'from': 'sender',
+    'to': 'recipients',
+    'subject': 'subject',
+    'body': 'body',
+}
+# query field -> how a CCYY-MM-DD bound compares to the message epoch
+DATES = {
+    'after': 'messages.epoch >= ?',
+    'since': 'messages.epoch >= ?',
+    'before': 'messages.epoch < ?',
+}
+QUERY_TOKEN = re.compile(r'\s*(?:([()])|(-?)(?:(\w+):)?("[^"]*"|[^\s()"]+))')
+TAG = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]*>', re.DOTALL | re.I)
+BODY_LIMIT = 256 * 1024 # characters of body text indexed per message
+BATCH = 1000
+INLINE = 200 # fewer new files than this are not worth starting processes
+
+def headerText(value):
+    if value is None:
+        return ''
+    try:
+        return str(email.header.make_header(
+            email.header.decode_header(str(value))))
+    except (LookupError, UnicodeError, ValueError):
+        return str(value)
+
+def partText(part):
+    payload = part.get_payload(decode=True) or b''
+    try:
+        return payload.decode(part.get_content_charset() or 'us-ascii',
+                              'replace')
+    except LookupError: # a charset Python does not know
+        return payload.decode('utf-8', 'replace')
+
+def bodyText(msg):
+    # the text/plain parts that are not attachments, else the text/html
+    # ones with the markup taken out
+    plain = []
+    markup = []
+    for part in msg.walk():
+        if (part.is_multipart() or
+                'attachment' == part.get_content_disposition()):
+            continue
+        if 'text/plain' == part.get_content_type():
+            plain.append(partText(part))
+        elif 'text/html' == part.get_content_type():
+            markup.append(partText(part))
+    if plain:
+        return '\n'.join(plain)[:BODY_LIMIT]
+    return html.unescape(TAG.sub(' ', '\n'.join(markup)))[:BODY_LIMIT]
+
+def parseFile(path):
+    # runs in the worker processes
+    try:
+        with open(path, 'rb') as f:
+            msg = email.message_from_binary_file(f)
+    except OSError:
+        return None
+    epoch = gmailimap.filenameEpoch(path)
+    if epoch is None:
+        try:
+            epoch = int(email.utils.parsedate_to_datetime(
+                msg['date']).timestamp())
+        except (TypeError, ValueError):
+            epoch = 0
+    recipients = ' '.join(headerText(msg[name])
+                          for name in ('to', 'cc', 'bcc'))
+    return (path, epoch, headerText(msg['from']), recipients,
+            headerText(msg['subject']), bodyText(msg))
+
+def openIndex(indexFile):
+    import sqlite3
+    conn = sqlite3.connect(indexFile)
+    conn.executescript(SCHEMA)
+    return conn
+
+def messageFiles(directory):
+    # paths relative to directory; the folders --labelLinks makes hold
+    # hardlinks to the same messages, index each X-GM-MSGID once
+    seen = set()
+    for path in gmailimap.messageFiles(directory):
+        message_id = gmailimap.filenameMessageId(path)
+        if message_id is not None:
+            if message_id in seen:
+                continue
+            seen.add(message_id)
+        yield os.path.relpath(path, directory)
+
+def addMessages(conn, rows):
+    with conn:
+        for (path, epoch, sender, recipients, subject, body) in rows:
+            cursor = conn.execute('INSERT INTO messages (path, epoch, sender, '
+                                  'subject) VALUES (?, ?, ?, ?)',
+                                  (path, epoch, sender, subject))
+            conn.execute('INSERT INTO terms (rowid, sender, recipients, '
+                         'subject, body) VALUES (?, ?, ?, ?, ?)',
+                         (cursor.lastrowid, sender, recipients, subject,
+                          body))
+
+def updateIndex(conn, directory, workers=None, debug=0):
+    # returns [added, removed]; files already in the index are not opened
+    indexed = set(row[0] for row in conn.execute('SELECT path FROM messages'))
+    paths = list(messageFiles(directory))
+    new = [path for path in paths if path not in indexed]
+    gone = indexed - set(paths)
+    # a contentless index cannot forget a message's terms without being
+    # given them again, so only the messages row goes; its id is never
+    # reused, so the terms left behind match nothing
+    with conn:
+        conn.executemany('DELETE FROM messages WHERE path = ?',
+                         ((path,) for path in gone))
+    if debug > 0: print(f'new:{len(new)} gone:{len(gone)}')
+    full = [os.path.join(directory, path) for path in new]
+    if len(new) < INLINE or 1 == workers:
+        results = map(parseFile, full)
+        executor = None
+    else:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(parseFile, full, chunksize=64)
+    added = 0
+    rows = []
+    try:
+        for path, row in zip(new, results):
+            if row is None:
+                if debug > 0: print(f'{path}: unreadable')
+                continue
+            rows.append((path,) + row[1:])
+            if BATCH <= len(rows):
+                addMessages(conn, rows)
+                added += len(rows)
+                rows = []
+                if debug > 0: print(f'indexed:{added}/{len(new)}')
+        addMessages(conn, rows)
+        added += len(rows)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    if len(indexed) < added:
+        # mostly new: merge the index segments once, for faster queries
+        with conn:
+            conn.execute("INSERT INTO terms (terms) VALUES ('optimize')")
+    return [added, len(gone)]
+
+def dateEpoch(value):
+    day = datetime.datetime.strptime(value, '%Y-%m-%d')
+    return int(day.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+def parseQuery(query):
+    # e.g. from:alice subject:"quarterly report" (invoice OR receipt)
+    # -draft after:2020-01-01 -> an FTS5 MATCH expression, plus the
+    # conditions and parameters for the date bounds
+    terms = []
+    where = []
+    params = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        mo = QUERY_TOKEN.match(query, position)
+        if mo is None:
+            raise ValueError(f'cannot parse {query[position:]!r}')
+        position = mo.end()
+        (paren, negate, field, value) = mo.groups()
+        if paren:
+            terms.append(paren)
+            continue
+        field = (field or '').lower()
+        if field in DATES:
+            try:
+                params.append(dateEpoch(value))
+            except ValueError:
+                raise ValueError(f'{field}:{value} is not a CCYY-MM-DD date')
+            where.append(DATES[field])
+            continue
+        if field and field not in FIELDS:
+            raise ValueError(f'unknown field {field}: in {mo.group().strip()}')
+        if not field and not negate and value in ('AND', 'OR', 'NOT'):
+            terms.append(value)
+            continue
+        prefix = value.endswith('*') and not value.startswith('"')
+        phrase = '"{}"'.format(value.strip('"').rstrip('*').replace('"', '""'))
+        if prefix:
+            phrase += '*'
+        if field:
+            phrase = f'{FIELDS[field]} : {phrase}'
+        terms.append(f'NOT {phrase}' if negate else phrase)
+    if terms and terms[0].startswith('NOT'):
+        # FTS5 only takes NOT between two expressions
+        raise ValueError('a query needs something to match before NOT or -')
+    return ' '.join(terms), where, params
+
+def search(conn, query, limit=50, debug=0):
+    # newest first: (epoch, path, sender, subject) and the number of matches
+    match, where, params = parseQuery(query)
+    if debug > 0: print(f'match:{match!r} where:{where} params:{params}')
+    if match:
+        source = 'messages JOIN terms ON terms.rowid = messages.id'
+        where = ['terms MATCH ?'] + where
+        params = [match] + params
+    else:
+        source = 'messages'
+    condition = ' AND '.join(where) or '1'
+    count = conn.execute(f'SELECT count(*) FROM {source} WHERE {condition}',
+                         params).fetchone()[0]
+    rows = conn.execute('SELECT messages.epoch, messages.path, '
+                        'messages.sender, messages.subject '
+                        f'FROM {source} WHERE {condition} '
+                        'ORDER BY messages.epoch DESC LIMIT ?',
+                        params + [limit]).fetchall()
+    return rows, count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        epilog='query fields: from: to: subject: body: after: before: '
+        '(dates as CCYY-MM-DD); words are ANDed, use OR, NOT or a leading - '
+        'and parentheses for the rest, "quotes" for phrases, a trailing * '
+        'for prefixes')
+    parser.add_argument('-d', '--debug', action='count', default=0,
+                        help='increase debug verbosity')
+    parser.add_argument('-D', '--messageDir', default='.',
+                        help='directory --copy wrote the messages to')
+    parser.add_argument('--indexFile', default='search.sqlite',
+                        help='SQLite full text index')
+    parser.add_argument('--update', action='store_true',
+                        help='index the messages added since the last '
+                        'update, and forget the removed ones')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes parsing messages during --update, '
+                        'one per CPU by default')
+    parser.add_argument('--limit', type=int, default=50,
+                        help='most matches to print, newest first')
+    parser.add_argument('--count', action='store_true',
+                        help='only print the number of matches')
+    parser.add_argument('query', nargs='*',
+                        help='what to search for, see below')
+    args = parser.parse_args(argv)
+    if not args.update and not args.query:
+        parser.error('give a query, --update, or both')
+    conn = openIndex(args.indexFile)
+    if args.update:
+        (added, removed) = updateIndex(conn, args.messageDir, args.workers,
+                                       args.debug)
+        print(f'indexed:{added} removed:{removed}')
+    if args.query:
+        try:
+            rows, count = search(conn, ' '.join(args.query), args.limit,
+                                 args.debug)
+        except ValueError as e:
+            parser.error(str(e))
+        except conn.OperationalError as e: # e.g. NOT with nothing before it
+            parser.error(f'bad query: {e}')
+        if not args.count:
+            for (epoch, path, sender, subject) in rows:
+                day = datetime.datetime.fromtimestamp(
+                    epoch, datetime.timezone.utc).strftime('%Y-%m-%d')
+                print(f'{day} {path} {sender} | {subject}')
+        print(f'matches:{count}')
+    conn.close()
+
+if '__main__' == __name__:
+    main()
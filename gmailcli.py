@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+# one entry point for all the tools: only the module for the subcommand is
+# imported, and each of those imports the google packages and dateutil only
+# on the code paths that need them
+
+import importlib
+import sys
+
+COMMANDS = {
+    'imap': ('gmailimap', 'list, count, copy, delete and append over IMAP'),
+    'smtp': ('gmailsmtp', 'send mail over SMTP'),
+    'send': ('gmailsend', 'send mail through the Gmail API'),
+    'pack': ('gmail_pack', 'read and export --copy --format pack archives'),
+    'search': ('gmail_search', 'full text search over --copy files'),
+    'token': ('writeGoogleBearerToken', 'generate refresh and access tokens'),
+}
+
+def usage(f):
+    print('usage: gmailcli.py COMMAND [options]\n\ncommands:', file=f)
+    for command, (module, help) in COMMANDS.items():
+        print(f'  {command:8}{help}', file=f)
+    print('\nrun gmailcli.py COMMAND -h for the options of a command', file=f)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        usage(sys.stdout if argv else sys.stderr)
+        sys.exit(0 if argv else 2)
+    if argv[0] not in COMMANDS:
+        print(f'gmailcli.py: unknown command {argv[0]}', file=sys.stderr)
+        usage(sys.stderr)
+        sys.exit(2)
+    # argparse names the program after sys.argv[0]
+    sys.argv[0] = f'{sys.argv[0]} {argv[0]}'
+    module = importlib.import_module(COMMANDS[argv[0]][0])
+    module.main(argv[1:])
+
+if '__main__' == __name__:
+    main()
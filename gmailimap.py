@@ -1,23 +1,38 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import contextlib
 import datetime
-import dateutil.parser
-import dateutil.tz
 import email
+import functools
+import gmail_lib
+import gmail_metrics
 import imaplib
+import importlib.util
+import json
 import os
 import re
+import socket
 import sys
 import time
-from gmail_lib import refreshToken
-from google.oauth2.credentials import Credentials
+import zlib
 
+CHUNK_SIZE = 8 * 1024 * 1024
+LINE_LIMIT = 8000
+ALL_MAIL = '[Gmail]/All Mail'
 EPOCHSTR = '1970-01-01 00:00:00 +0000'
-EPOCH = dateutil.parser.parse(EPOCHSTR)
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+NUMERIC_ZONE = re.compile(r'\d:\d\d(?::\d\d)? [+-]\d{4}\b|\b(?:GMT|UTC?)\b')
+# UID SEARCH answers in a single line, about seven bytes per message, which
+# runs past imaplib's one megabyte limit at around 140,000 messages
+imaplib._MAXLINE = 64 * 1024 * 1024
+# RFC 4978, imaplib does not know the command
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+READ_SIZE = 64 * 1024
 TZINFOS = {
-    'EDT': dateutil.tz.gettz('America/New_York'),
-    'EST': dateutil.tz.gettz('America/New_York')
+    'EDT': 'America/New_York',
+    'EST': 'America/New_York'
 }
 
 def dt_is_naive(dt):
@@ -25,14 +40,23 @@ def dt_is_naive(dt):
         return True
     return False
 
-def parseArgs():
+def parseArgs(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='count', default=0,
                         help='increase debug verbosity')
-    parser.add_argument('-u', '--username', required=True,
+    parser.add_argument('-u', '--username',
                         help='IMAP username')
     parser.add_argument('-t', '--tokenFile', default=None,
                         help='OAuth token file')
+    parser.add_argument('--stateFile', default=None,
+                        help='sync state file, makes --copy, --flags and '
+                        '--backup incremental (--flags and the labels of '
+                        '--backup keep their own next to it, e.g. '
+                        'state.flags.json)')
+    parser.add_argument('--indexFile', default=None,
+                        help='SQLite metadata index for --index and --offline')
+    parser.add_argument('--offline', action='store_true',
+                        help='answer --list and --count from --indexFile')
     parser.add_argument('-m', '--mailbox', default='[Gmail]/All Mail',
                         help='name of mailbox to use')
     parser.add_argument('--before',
@@ -51,6 +75,9 @@ def parseArgs():
                        help='search to')
     parser.add_argument('--subject',
                        help='search subject')
+    parser.add_argument('--gmailQuery',
+                        help='search with Gmail search syntax (X-GM-RAW), '
+                        "e.g. 'from:alice has:attachment older_than:2y'")
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--list', action='store_true',
                        help='list mailboxes')
@@ -60,28 +87,95 @@ def parseArgs():
                        help='copy messages to Maildir compatible filenames')
     group.add_argument('-i', '--interactiveDelete', action='store_true',
                        help='ask to delete messages one by one')
+    group.add_argument('--delete', action='store_true',
+                       help='delete all messages matching the search')
     group.add_argument('-e', '--envelopes', action='store_true',
                        help='print all envelope data')
     group.add_argument('-f', '--flags', action='store_true',
                        help='print all flags')
     group.add_argument('-a', '--append',
                        help='append this file')
-    args = parser.parse_args()
+    group.add_argument('--appendDir',
+                       help='append every message in this Maildir or '
+                       '*.gmail directory tree')
+    group.add_argument('--index', action='store_true',
+                       help='build or update the metadata index')
+    group.add_argument('--backup', action='store_true',
+                       help='copy every message once from All Mail and '
+                       'record the labels of each in --manifest')
+    parser.add_argument('--manifest', default='labels.json',
+                        help='with --backup, the X-GM-MSGID to labels file')
+    parser.add_argument('--labelLinks', default=None,
+                        help='with --backup, also hardlink every message '
+                        'into a folder per label below this directory')
+    parser.add_argument('--dryRun', action='store_true',
+                        help='with --delete, only count matching messages')
+    parser.add_argument('--batchSize', type=int, default=500,
+                        help='number of messages per UID FETCH')
+    parser.add_argument('--format', choices=('files', 'pack'),
+                        default='files',
+                        help='--copy to one file per message, or to pack '
+                        'files with an index (see gmail_pack.py)')
+    parser.add_argument('--packCompression', choices=('none', 'gzip', 'zstd'),
+                        default='none',
+                        help='compress each message in the pack files, zstd '
+                        'needs the zstandard package')
+    parser.add_argument('--packSize', type=int, default=1024 * 1024 * 1024,
+                        help='start a new pack file past this many bytes')
+    parser.add_argument('--chunkSize', type=int, default=CHUNK_SIZE,
+                        help='most message bytes to fetch per round trip')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of parallel IMAP connections for --copy, '
+                        '--appendDir and --list')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the connection with COMPRESS=DEFLATE '
+                        'when the server offers it')
+    parser.add_argument('--progress', action='store_true',
+                        help='show a progress line with an ETA on stderr')
+    parser.add_argument('--metrics', default=None,
+                        help='write command latencies, phase timings and '
+                        'counters to this file at the end, as a Prometheus '
+                        'textfile if it ends in .prom, else as JSON lines')
+    args = parser.parse_args(argv)
+    if not args.offline and not args.username:
+        parser.error('the following arguments are required: -u/--username')
+    if (args.index or args.offline) and not args.indexFile:
+        parser.error('--index and --offline need --indexFile')
+    if args.delete and not any((args.before, args.on, args.since, args.bcc,
+                                args.cc, args.sender, args.to, args.subject,
+                                args.gmailQuery)):
+        parser.error('--delete needs at least one search option')
+    if args.offline and not (args.list or args.count):
+        parser.error('--offline only answers --list and --count')
+    if args.offline and args.gmailQuery:
+        parser.error('--gmailQuery runs on the server, not with --offline')
+    if args.labelLinks and 'files' != args.format:
+        parser.error('--labelLinks needs --format files')
+    if args.labelLinks and isWithin(os.getcwd(), args.labelLinks):
+        # pruning stale links would delete the copies themselves
+        parser.error('--labelLinks must not hold the directory the '
+                     'messages are copied to')
+    if ('zstd' == args.packCompression and
+            importlib.util.find_spec('zstandard') is None):
+        parser.error('--packCompression zstd needs the zstandard package')
     return args
 
-def gmailLogin(username, tokenFile=None, debug=0):
+def isWithin(path, directory):
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return path == directory or path.startswith(directory.rstrip(os.sep) +
+                                                os.sep)
+
+def gmailLogin(username, tokenFile=None, debug=0, compress=False):
     m = imaplib.IMAP4_SSL('imap.gmail.com')
+    # imaplib sends a command, its literal and the closing CRLF separately,
+    # don't let Nagle hold the last one back until the server's delayed ACK
+    m.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     if debug > 0:
         print('about to log in')
         m.debug = debug # setting to 4 seems quite verbose
     if tokenFile:
-        credentials = Credentials.from_authorized_user_file(tokenFile)
-        if credentials.expired:
-            if debug > 0: print('access token expired, refreshing')
-            refreshToken(tokenFile, credentials)
-        auth_string = 'user=%s\1auth=Bearer %s\1\1' % (username,
-                                                       credentials.token)
-        if debug > 1: print(auth_string)
+        auth_string = gmail_lib.authString(username, tokenFile, debug)
         m.authenticate('XOAUTH2', lambda x: auth_string)
     else:
         password = os.getenv('GoogleDocsPassWord')
@@ -90,8 +184,115 @@ def gmailLogin(username, tokenFile=None, debug=0):
             sys.exit(1)
         m.login(username, password)
     if debug > 0: print('just logged in')
+    # servers advertise more once authenticated, e.g. CONDSTORE and ENABLE
+    status, response = m.capability()
+    if 'OK' == status:
+        m.capabilities = tuple(response[-1].decode('utf-8').upper().split())
+    if compress:
+        enableCompression(m, debug)
+    if gmail_metrics.METRICS.enabled:
+        gmail_metrics.METRICS.instrument(m)
     return m
 
+class DeflateStream:
+    # after COMPRESS DEFLATE each direction is a single raw deflate stream;
+    # every write is flushed so the server sees whole commands
+    def __init__(self, m):
+        self.file = m.file
+        self.sock = m.sock
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.buffer = bytearray()
+
+    def fill(self):
+        data = self.file.read1(READ_SIZE)
+        gmail_metrics.METRICS.count('imap_wire_received_bytes_total',
+                                    len(data))
+        self.buffer += self.decompressor.decompress(data)
+        return data
+
+    def readline(self):
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start) + 1
+            if end:
+                break
+            if len(self.buffer) > imaplib._MAXLINE:
+                raise imaplib.IMAP4.error(
+                    f'got more than {imaplib._MAXLINE} bytes')
+            start = len(self.buffer)
+            if not self.fill():
+                end = len(self.buffer) # EOF, imaplib deals with it
+                break
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    def read(self, size):
+        while len(self.buffer) < size and self.fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def send(self, data):
+        data = (self.compressor.compress(data) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        gmail_metrics.METRICS.count('imap_wire_sent_bytes_total', len(data))
+        self.sock.sendall(data)
+
+def enableCompression(m, debug):
+    if 'COMPRESS=DEFLATE' not in m.capabilities:
+        if debug > 0: print('server does not offer COMPRESS=DEFLATE')
+        return False
+    status, response = m._simple_command('COMPRESS', 'DEFLATE')
+    if debug > 1: print(f'status:{status} response:{response}')
+    if 'OK' != status:
+        return False
+    stream = DeflateStream(m)
+    m.read = stream.read
+    m.readline = stream.readline
+    m.send = stream.send
+    if debug > 0: print('compression enabled')
+    return True
+
+def loadState(stateFile):
+    if stateFile is None or not os.path.exists(stateFile):
+        return {}
+    with open(stateFile, 'r') as f:
+        return json.load(f)
+
+def saveState(stateFile, state):
+    if stateFile is None:
+        return
+    # write to the side and rename so an interrupted run keeps the old state
+    with open(f'{stateFile}.tmp', 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+        f.write('\n')
+    os.replace(f'{stateFile}.tmp', stateFile)
+
+def selectMailbox(m, mailbox, readonly, debug):
+    status, response = m.select(f'"{mailbox}"', readonly=readonly)
+    if debug > 1: print(f'status:{status} response:{response}')
+    if 'OK' != status:
+        return None
+    info = {'exists': int(response[-1])}
+    for code in ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+        if code in m.untagged_responses:
+            info[code.lower()] = int(m.untagged_responses[code][-1])
+    if debug > 0: print(f'{mailbox}:{info}')
+    return info
+
+def mailboxState(state, mailbox, info, debug):
+    mailbox_state = state.get(mailbox, {})
+    if mailbox_state.get('uidvalidity') != info['uidvalidity']:
+        if mailbox_state: print(f'{mailbox}: UIDVALIDITY changed, resyncing')
+        mailbox_state = {'uidvalidity': info['uidvalidity'], 'last_uid': 0}
+        state[mailbox] = mailbox_state
+    if debug > 0: print(f'{mailbox}: last_uid:{mailbox_state["last_uid"]}')
+    return mailbox_state
+
 def searchDate(preposition, dateArg, debug):
     dateString = datetime.datetime.strptime(dateArg,
                                             '%Y-%m-%d').strftime('%d-%b-%Y')
@@ -104,18 +305,51 @@ def searchString(preposition, stringArg, debug):
     if debug > 0: print (searchString)
     return searchString
 
-def countMessages(m, mailbox, criterion, debug):
-    status, response = m.select(f'"{mailbox}"', readonly=True)
+def searchRaw(query, debug):
+    # Gmail's own search syntax, run against its index rather than the
+    # IMAP SEARCH keys
+    query = query.replace('\\', '\\\\').replace('"', '\\"')
+    searchString = f'(X-GM-RAW "{query}")'
+    if debug > 0: print (searchString)
+    return searchString
+
+def mailboxStatus(m, mailbox, debug):
+    status, response = m.status(f'"{mailbox}"', '(MESSAGES UNSEEN UIDNEXT)')
     if debug > 1: print(f'status:{status} response:{response}')
     assert('OK' == status)
+    # e.g. b'"INBOX" (MESSAGES 23 UNSEEN 1 UIDNEXT 24)'
+    items = re.search(r'\(([^()]*)\)\s*$',
+                      response[-1].decode('utf-8')).group(1).split()
+    return {key.lower(): int(value)
+            for key, value in zip(items[::2], items[1::2])}
+
+def countMessages(m, mailbox, criterion, debug):
     if criterion:
+        status, response = m.select(f'"{mailbox}"', readonly=True)
+        if debug > 1: print(f'status:{status} response:{response}')
+        assert('OK' == status)
         if debug > 1: print(f'using this search criterion: {criterion}')
-        status, response = m.search(None, ' '.join(criterion))
-        if debug > 1: print(f'status: {status} response: {response}')
-        return len(response[0].split())
+        return len(searchRanges(m, debug, ' '.join(criterion)))
+    else:
+        # STATUS answers without the cost of selecting the mailbox
+        if debug > 1: print(f'using status only')
+        mailbox_status = mailboxStatus(m, mailbox, debug)
+        if debug > 0: print(f'{mailbox}:{mailbox_status}')
+        return mailbox_status['messages']
+
+def countMailboxes(m, mailboxes, criterion, debug, workers=1, login=None):
+    if 1 < workers and login is not None:
+        results = runParallel(
+            login, None, mailboxes,
+            lambda w, mailbox: countMessages(w, mailbox, criterion, debug),
+            workers, debug)
     else:
-        if debug > 1: print(f'using select only')
-        return response[0].decode('utf-8')
+        results = ((mailbox, countMessages(m, mailbox, criterion, debug),
+                    None) for mailbox in mailboxes)
+    counts = {}
+    for mailbox, message_count, error in results:
+        counts[mailbox] = message_count if error is None else f'error:{error}'
+    return [(mailbox, counts[mailbox]) for mailbox in mailboxes]
 
 def listMailboxes(m, debug):
     mailboxes = []
@@ -131,88 +365,583 @@ def listMailboxes(m, debug):
             mailboxes.append(mailbox.split('"')[-2])
     return mailboxes
 
-def getMessage(m, msg_uid, debug):
-    status, response = m.uid('FETCH', msg_uid,
-#                             '(RFC822 X-GM-LABELS X-GM-THRID X-GM-MSGID)')
-                             '(RFC822 X-GM-MSGID)')
-    if debug > 1: print(f'status:{status} response:{response}')
-    if debug > 0: print('msgUID:{} len:{}'.format(msg_uid,len(response)))
-    assert('OK' == status)
-    assert(type(response) == list)
-    assert(2 <= len(response))
-    assert(type(response[0]) == tuple)
-    assert(2 <= len(response[0]))
-    (imap_data, message_data) = response[0]
-    imap_data = imap_data.decode('utf-8')
-    message_data = message_data.decode('utf-8')
-    if debug > 1: print(f'imap_data:{imap_data}')
-    pattern = re.compile('X-GM-MSGID\s+(\d+)')
-    message_id = pattern.search(imap_data).group(1)
-    return message_data, message_id
-
-def copyMessages(m, mailbox, debug):
-    status, response = m.select(mailbox, readonly=True)
-    if debug > 1: print(response)
-    if 'OK' != status:
-        return 'mailbox not found'
-    status, response = m.uid('search', None, 'ALL')
+FETCH_START = re.compile(rb'^\d+ \(')
+LITERAL = re.compile(r'\{\d+\}$')
+TOKEN = re.compile(
+    r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|((?:[^\s()"\[\]]|\[[^\]]*\])+))')
+
+def tokenizeFetch(segments):
+    for text, literal in segments:
+        if literal is not None:
+            text = LITERAL.sub('', text.rstrip())
+        pos = 0
+        while True:
+            mo = TOKEN.match(text, pos)
+            if mo is None:
+                break
+            pos = mo.end()
+            if mo.group(1):
+                yield '(', None
+            elif mo.group(2):
+                yield ')', None
+            elif mo.group(3) is not None:
+                yield 'value', re.sub(r'\\(.)', r'\1', mo.group(3))
+            elif 'NIL' == mo.group(4).upper():
+                yield 'value', None
+            else:
+                yield 'value', mo.group(4)
+        if literal is not None:
+            yield 'value', literal
+
+def parseFetchItems(segments):
+    stack = [[]]
+    for kind, value in tokenizeFetch(segments):
+        if '(' == kind:
+            stack.append([])
+        elif ')' == kind:
+            if len(stack) > 1:
+                done = stack.pop()
+                stack[-1].append(done)
+        else:
+            stack[-1].append(value)
+    parsed = stack[0]
+    # parsed looks like: ['1', ['UID', '5', 'X-GM-MSGID', '123', ...]]
+    if 2 > len(parsed) or list != type(parsed[1]):
+        return {}
+    items = parsed[1]
+    return {str(key).upper(): value
+            for key, value in zip(items[::2], items[1::2])}
+
+def parseFetchResponse(response):
+    # imaplib hands back a flat list: a (head, literal) tuple per literal,
+    # followed by the bytes that trail the literal; a new message starts
+    # with its sequence number, e.g. b'12 (UID 34 RFC822 {567}'
+    records = []
+    for item in response:
+        if item is None:
+            continue
+        if tuple == type(item):
+            head, literal = item
+        else:
+            head, literal = item, None
+        if FETCH_START.match(head):
+            records.append([])
+        if records:
+            records[-1].append((head.decode('utf-8', 'replace'), literal))
+    return [parseFetchItems(record) for record in records]
+
+def searchUids(m, debug, criterion='ALL'):
+    status, response = m.uid('search', None, criterion)
     if debug > 1: print(response)
     assert('OK' == status)
-    assert(type(response == list))
+    assert(type(response) == list)
     assert(1 == len(response))
-    message_count = 0
-    for msg_uid in response[0].split():
-        message_count +=1
-        (message_data, message_id) = getMessage(m, msg_uid, debug)
-        parsed_msg = email.message_from_string(message_data)
-        date_from_message = parsed_msg['date']
-        if debug > 0:
-            print(f'Date: {date_from_message}')
-            print('Subject: {}'.format(parsed_msg['subject']))
-        if date_from_message is None:
-            date_from_message = EPOCHSTR
+    return [int(uid) for uid in response[0].split()]
+
+class UidRanges:
+    # ascending (first, last) UID ranges, as ESEARCH ALL sends them; a
+    # mailbox of millions of messages is a handful of tuples, and batches
+    # come out as uid sets without ever listing the UIDs one by one
+    def __init__(self, ranges=()):
+        self.ranges = list(ranges)
+        self.count = sum(hi - lo + 1 for lo, hi in self.ranges)
+
+    @classmethod
+    def parse(cls, uid_set):
+        ranges = []
+        for part in uid_set.split(','):
+            lo, _, hi = part.partition(':')
+            lo, hi = int(lo), int(hi or lo)
+            ranges.append((min(lo, hi), max(lo, hi)))
+        # a server may send them in any order, overlapping or adjacent
+        merged = []
+        for lo, hi in sorted(ranges):
+            if merged and lo <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        return cls((lo, hi) for lo, hi in merged)
+
+    @classmethod
+    def fromUids(cls, uids):
+        ranges = []
+        for uid in sorted(uids):
+            if ranges and uid == ranges[-1][1] + 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        return cls((lo, hi) for lo, hi in ranges)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for lo, hi in self.ranges:
+            yield from range(lo, hi + 1)
+
+    def __contains__(self, uid):
+        i = bisect.bisect_right(self.ranges, (uid, float('inf')))
+        return 0 < i and uid <= self.ranges[i - 1][1]
+
+    def __str__(self):
+        return ','.join(str(lo) if lo == hi else f'{lo}:{hi}'
+                        for lo, hi in self.ranges)
+
+    def last(self):
+        return self.ranges[-1][1] if self.ranges else None
+
+    def above(self, uid):
+        return UidRanges((max(lo, uid + 1), hi) for lo, hi in self.ranges
+                         if hi > uid)
+
+    def below(self, uid):
+        return UidRanges((lo, min(hi, uid - 1)) for lo, hi in self.ranges
+                         if lo < uid)
+
+    def batches(self, batch_size):
+        # UidRanges of batch_size UIDs each, the last one maybe fewer
+        batch = []
+        room = batch_size
+        for lo, hi in self.ranges:
+            while lo <= hi:
+                end = min(hi, lo + room - 1)
+                batch.append((lo, end))
+                room -= end - lo + 1
+                lo = end + 1
+                if 0 == room:
+                    yield UidRanges(batch)
+                    batch = []
+                    room = batch_size
+        if batch:
+            yield UidRanges(batch)
+
+def searchRanges(m, debug, criterion='ALL'):
+    # ESEARCH (RFC 4731) answers with a count and compact ranges instead of
+    # every matching UID; without it, plain SEARCH is folded into ranges
+    if 'ESEARCH' not in m.capabilities:
+        return UidRanges.fromUids(searchUids(m, debug, criterion))
+    status, response = m.uid('SEARCH', 'RETURN (MIN MAX COUNT ALL)',
+                             criterion)
+    assert('OK' == status)
+    # e.g. b'(TAG "A5") UID MIN 3 MAX 12 COUNT 6 ALL 3:5,10:12'
+    response = b' '.join(m.untagged_responses.pop('ESEARCH', [b'']))
+    if debug > 1: print(f'status:{status} response:{response[:200]}')
+    items = re.sub(r'^\s*\([^)]*\)', '', response.decode('utf-8')).split()
+    results = dict(zip(items[1::2], items[2::2]))
+    if 'ALL' not in results: # nothing matched
+        return UidRanges()
+    ranges = UidRanges.parse(results['ALL'])
+    assert(len(ranges) == int(results.get('COUNT', len(ranges))))
+    return ranges
+
+# what a failed job raises: a NO or BAD reply, a dropped connection
+JOB_ERRORS = (imaplib.IMAP4.error, OSError, AssertionError)
+
+def runSerial(m, jobs, work, debug):
+    # runParallel on the one connection m: a job that fails is reported as
+    # its (job, None, error) and the next one goes ahead
+    for job in jobs:
         try:
-            dt = dateutil.parser.parse(date_from_message)
-        except ValueError:
-            print('Got a ValueError, try fuzzy')
-            dt = dateutil.parser.parse(date_from_message, fuzzy=True)
-        if dt_is_naive(dt):
-            print('Performing TZ name lookup')
+            result = (job, work(m, job), None)
+        except JOB_ERRORS as e:
+            if debug > 0: print(f'job:{job} error:{e}')
+            result = (job, None, e)
+        yield result
+
+def runJobs(m, jobs, work, debug, workers=1, login=None, setup=None):
+    if 1 < workers and login is not None:
+        return runParallel(login, setup, jobs, work, workers, debug)
+    return runSerial(m, jobs, work, debug)
+
+def runParallel(login, setup, jobs, work, workers, debug, retries=3):
+    # jobs share a pool of connections; a job that fails is retried on a
+    # fresh one, results come back as (job, result, error) as they finish
+    def connect():
+        m = login()
+        if setup:
+            setup(m)
+        return m
+    import concurrent.futures
+    pool = gmail_lib.SessionPool(connect, lambda m: gmailLogout(m, debug),
+                                 workers)
+    def run(job):
+        for attempt in range(retries + 1):
             try:
-                dt = dateutil.parser.parse(date_from_message, tzinfos=TZINFOS)
-            except ValueError:
-                print('Got a ValueError, strip last word, force UTC')
-                dt = dateutil.parser.parse(' '.join(
-                    date_from_message.split()[:-1])).replace(
-                        tzinfo=dateutil.tz.tzutc()
-                    )
-        if dt_is_naive(dt):
-            print('TZ name lookup failed, forcing UTC')
-            dt = dateutil.parser.parse(date_from_message).replace(
-                tzinfo=dateutil.tz.tzutc()
-            )
-        filename = '{}.{}.gmail'.format(int((dt - EPOCH).total_seconds()),
-                                        message_id)
-        with open(filename, 'w') as f:
-            f.write(message_data)
-
-def interactiveDelete(m, mailbox, debug):
-    fd = sys.stdin.fileno()
-    status, response = m.select(mailbox, readonly=False)
-    if debug > 1: print(response)
-    if 'OK' != status:
+                with pool.session() as m:
+                    return job, work(m, job), None
+            except JOB_ERRORS as e:
+                if debug > 0: print(f'job:{job} attempt:{attempt} error:{e}')
+                if attempt == retries:
+                    return job, None, e
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(run, job) for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        pool.close()
+
+def getHeaders(m, uid_set, debug, fields='DATE SUBJECT'):
+    status, response = m.uid('FETCH', uid_set, '(UID X-GM-MSGID RFC822.SIZE '
+                             'INTERNALDATE '
+                             f'BODY.PEEK[HEADER.FIELDS ({fields})])')
+    if debug > 1: print(f'status:{status} response:{response}')
+    assert('OK' == status)
+    headers = []
+    with gmail_metrics.METRICS.timer('parse'):
+        for item in parseFetchResponse(response):
+            if 'RFC822.SIZE' not in item:
+                continue # e.g. an unsolicited FLAGS update
+            header_data = [value for key, value in item.items()
+                           if key.startswith('BODY[HEADER.FIELDS')]
+            parsed_headers = email.message_from_bytes(
+                (header_data or [b''])[0] or b'')
+            headers.append((int(item['UID']), item['X-GM-MSGID'],
+                            int(item['RFC822.SIZE']), parsed_headers,
+                            internaldateEpoch(item['INTERNALDATE'])))
+    return sorted(headers, key=lambda header: header[0])
+
+def fetchBody(m, msg_uid, size, f, chunk_size, debug):
+    # BODY.PEEK[]<offset.length> keeps each literal below chunk_size; the
+    # RFC822.SIZE is only a hint, the body ends at the first short chunk
+    offset = 0
+    while True:
+        status, response = m.uid('FETCH', str(msg_uid),
+                                 f'(UID BODY.PEEK[]<{offset}.{chunk_size}>)')
+        assert('OK' == status)
+        with gmail_metrics.METRICS.timer('parse'):
+            items = parseFetchResponse(response)
+        data = b''
+        for item in items:
+            if f'BODY[]<{offset}>' in item:
+                data = item[f'BODY[]<{offset}>'] or b''
+                with gmail_metrics.METRICS.timer('write'):
+                    f.write(data)
+        offset += len(data)
+        if debug > 0: print(f'msgUID:{msg_uid} {offset}/{size}')
+        if len(data) < chunk_size:
+            return offset
+
+class FileSink:
+    # where --copy puts messages by default: one <epoch>.<X-GM-MSGID>.gmail
+    # file each in the current directory; see gmail_pack for the other kind
+    def exists(self, message_id):
+        # a file is named for its epoch as well, which is only known once
+        # the headers are parsed; copying a message again rewrites it
+        return False
+
+    def write(self, epoch, message_id, data):
+        with open(f'{epoch}.{message_id}.gmail', 'wb') as f:
+            f.write(data)
+
+    @contextlib.contextmanager
+    def open(self, epoch, message_id):
+        # for messages written a piece at a time, never leave half of one
+        filename = f'{epoch}.{message_id}.gmail'
+        with open(f'{filename}.tmp', 'wb') as f:
+            yield f
+        os.replace(f'{filename}.tmp', filename)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+def copyBatch(m, uid_set, debug, chunk_size=CHUNK_SIZE, sink=None):
+    # fetch the small headers for the whole batch first, then the bodies in
+    # groups that stay below chunk_size bytes, so memory does not grow with
+    # the batch size or the message size
+    sink = sink or FileSink()
+    headers = getHeaders(m, uid_set, debug)
+    # the X-GM-MSGIDs the sink already has need no body
+    message_count = len(headers)
+    headers = [header for header in headers
+               if not sink.exists(int(header[1]))]
+    message_count -= len(headers)
+    groups = []
+    group_size = 0
+    for header in headers:
+        size = header[2]
+        if chunk_size < size:
+            continue
+        if not groups or chunk_size < group_size + size:
+            groups.append([])
+            group_size = 0
+        groups[-1].append(header)
+        group_size += size
+    missing = []
+    for group in groups:
+        by_uid = {header[0]: header for header in group}
+        status, response = m.uid('FETCH', str(UidRanges.fromUids(by_uid)),
+                                 '(UID BODY.PEEK[])')
+        if debug > 1: print(f'status:{status} response:{response}')
+        assert('OK' == status)
+        with gmail_metrics.METRICS.timer('parse'):
+            items = parseFetchResponse(response)
+        del response
+        for item in items:
+            if 'BODY[]' not in item or int(item['UID']) not in by_uid:
+                continue
+            (msg_uid, message_id, size, parsed_headers,
+             internaldate) = by_uid.pop(int(item['UID']))
+            with gmail_metrics.METRICS.timer('date'):
+                epoch = messageEpoch(parsed_headers, debug, internaldate)
+            with gmail_metrics.METRICS.timer('write'):
+                sink.write(epoch, message_id, item['BODY[]'])
+            message_count +=1
+            gmail_metrics.METRICS.count('messages_total')
+            gmail_metrics.METRICS.count('message_bytes_total',
+                                        len(item['BODY[]']))
+        del items
+        missing.extend(by_uid)
+    for (msg_uid, message_id, size, parsed_headers, internaldate) in headers:
+        if chunk_size < size:
+            with gmail_metrics.METRICS.timer('date'):
+                epoch = messageEpoch(parsed_headers, debug, internaldate)
+            with sink.open(epoch, message_id) as f:
+                size = fetchBody(m, msg_uid, size, f, chunk_size, debug)
+            message_count +=1
+            gmail_metrics.METRICS.count('messages_total')
+            gmail_metrics.METRICS.count('message_bytes_total', size)
+    if missing:
+        # expunged since the headers were fetched is fine, anything else
+        # must fail the batch so that it is not marked as copied
+        missing = searchRanges(m, debug, f'UID {UidRanges.fromUids(missing)}')
+        if missing:
+            raise imaplib.IMAP4.error(f'no body for uids:{missing}')
+    return message_count
+
+def copyMessages(m, mailbox, batch_size, debug, stateFile=None, workers=1,
+                 login=None, chunk_size=CHUNK_SIZE, sink=None):
+    sink = sink or FileSink()
+    info = selectMailbox(m, mailbox, True, debug)
+    if info is None:
         return 'mailbox not found'
-    status, response = m.uid('search', None, 'ALL')
-    if debug > 1: print(response)
+    state = loadState(stateFile)
+    mailbox_state = mailboxState(state, mailbox, info, debug)
+    last_uid = mailbox_state['last_uid']
+    # n:* always matches the highest UID, even when it is below n
+    uids = searchRanges(m, debug, f'UID {last_uid + 1}:*').above(last_uid)
+    batches = list(uids.batches(batch_size))
+    jobs = [(i, str(batch)) for i, batch in enumerate(batches)]
+    results = runJobs(
+        m, jobs, lambda w, job: copyBatch(w, job[1], debug, chunk_size, sink),
+        debug, workers, login,
+        lambda w: selectMailbox(w, mailbox, True, debug))
+    message_count = 0
+    gmail_metrics.METRICS.progress(mailbox, 0, len(uids))
+    done = [False] * len(jobs)
+    next_batch = 0
+    failed = []
+    for (i, uid_set), count, error in results:
+        if error is not None:
+            print(f'{mailbox}: failed uids:{uid_set} error:{error}')
+            failed.append(uid_set)
+            continue
+        message_count += count
+        done[i] = True
+        if debug > 0: print(f'{mailbox}: copied:{message_count}/{len(uids)}')
+        gmail_metrics.METRICS.progress(mailbox, message_count, len(uids))
+        # only advance past batches that are complete, so a failed or
+        # interrupted batch is fetched again on the next run
+        while next_batch < len(done) and done[next_batch]:
+            mailbox_state['last_uid'] = batches[next_batch].last()
+            next_batch += 1
+        # what the state file says is copied has to be on disk
+        sink.sync()
+        saveState(stateFile, state)
+    if failed:
+        print(f'{mailbox}: {len(failed)} batches failed')
+    return message_count
+
+def allMailMailbox(m, debug):
+    # the name is localized, e.g. [Google Mail]/All Mail, the special-use
+    # \All flag is not
+    status, response = m.list()
     assert('OK' == status)
-    assert(type(response == list))
-    assert(1 == len(response))
+    for mailbox in response:
+        mailbox = mailbox.decode('utf-8')
+        (flags, name) = (mailbox.split('"')[0], mailbox.split('"')[-2])
+        if r'\All' in flags.strip('() ').split():
+            if debug > 0: print(f'All Mail is {name}')
+            return name
+    return ALL_MAIL
+
+def messageLabels(m, mailbox, batch_size, debug, stateFile=None,
+                  manifest='labels.json'):
+    # X-GM-MSGID -> sorted labels, for every message in mailbox, written to
+    # manifest; with stateFile and CONDSTORE only the messages changed
+    # since the last run are fetched, the way --flags --stateFile does
+    condstore = enableExtension(m, 'CONDSTORE', debug)
+    info = selectMailbox(m, mailbox, True, debug)
+    if info is None:
+        return None
+    state = loadState(sideStateFile(stateFile, 'labels')) if stateFile else {}
+    mailbox_state = mailboxState(state, mailbox, info, debug)
+    messages = mailbox_state.setdefault('messages', {}) # UID -> X-GM-MSGID
+    modseq = mailbox_state.get('highestmodseq')
+    labels = loadState(manifest) if os.path.exists(manifest) else None
+    delta = (stateFile and condstore and modseq is not None and
+             'highestmodseq' in info and labels is not None)
+    if 0 == info['exists']:
+        fetches = []
+    elif delta:
+        fetches = [('1:*', f' (CHANGEDSINCE {modseq})')]
+    else:
+        labels = {}
+        messages.clear()
+        fetches = [(str(uid_set), '')
+                   for uid_set in searchRanges(m, debug).batches(batch_size)]
+    for uid_set, modifiers in fetches:
+        status, response = m.uid('FETCH', uid_set,
+                                 '(UID X-GM-MSGID X-GM-LABELS)' + modifiers)
+        if debug > 1: print(f'status:{status} response:{response}')
+        assert('OK' == status)
+        for item in parseFetchResponse(response):
+            if 'X-GM-MSGID' in item:
+                messages[item['UID']] = item['X-GM-MSGID']
+                labels[item['X-GM-MSGID']] = sorted(
+                    item.get('X-GM-LABELS') or [])
+    if delta:
+        present = searchRanges(m, debug)
+        for uid in [uid for uid in messages if int(uid) not in present]:
+            labels.pop(messages.pop(uid), None)
+    if debug > 0: print(f'{mailbox}: labels fetched:'
+                        f'{"changed" if delta else "all"}')
+    # the manifest first: the modseq must never be ahead of it
+    saveState(manifest, labels)
+    if stateFile:
+        if condstore and 'highestmodseq' in info:
+            mailbox_state['highestmodseq'] = info['highestmodseq']
+        saveState(sideStateFile(stateFile, 'labels'), state)
+    return labels
+
+def labelPath(label):
+    # \Inbox -> Inbox, nested labels become nested folders
+    parts = [part if part not in ('', '.', '..') else '_'
+             for part in label.lstrip('\\').split('/')]
+    return os.path.join(*parts)
+
+def labelLinks(labels, directory, debug):
+    # directory/<label>/<file> hardlinks to the files --copy wrote in the
+    # current directory; links for labels a message lost are removed
+    files = {filenameMessageId(f): f for f in os.listdir('.')
+             if filenameMessageId(f)}
+    wanted = set()
+    link_count = 0
+    for message_id, message_labels in labels.items():
+        filename = files.get(message_id)
+        if filename is None:
+            continue
+        for label in message_labels:
+            target = os.path.join(directory, labelPath(label), filename)
+            wanted.add(target)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.link(filename, target)
+                link_count += 1
+    for dirpath, dirnames, filenames in os.walk(directory, topdown=False):
+        if dirpath == directory:
+            continue # links only ever go in the per-label folders
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filenameMessageId(filename) and path not in wanted:
+                if debug > 0: print(f'unlinking {path}')
+                os.remove(path)
+        if not os.listdir(dirpath):
+            os.rmdir(dirpath) # a label no message has any more
+    return link_count
+
+def backup(m, batch_size, debug, stateFile=None, workers=1, login=None,
+           chunk_size=CHUNK_SIZE, sink=None, manifest='labels.json',
+           linkDir=None):
+    # every message is in All Mail exactly once, whatever its labels, so
+    # copy bodies from there and keep the labels on the side
+    mailbox = allMailMailbox(m, debug)
+    message_count = copyMessages(m, mailbox, batch_size, debug,
+                                 stateFile=stateFile, workers=workers,
+                                 login=login, chunk_size=chunk_size,
+                                 sink=sink)
+    if str == type(message_count):
+        return message_count
+    labels = messageLabels(m, mailbox, batch_size, debug, stateFile,
+                           manifest)
+    link_count = 0
+    if linkDir:
+        link_count = labelLinks(labels, linkDir, debug)
+    assignments = sum(len(message_labels) for message_labels in
+                      labels.values())
+    return [message_count, len(labels), assignments, link_count]
+
+def dateutilEpoch(date_from_message):
+    # dateutil is slow to import and only needed for odd Date headers
+    import dateutil.parser
+    import dateutil.tz
+    tzinfos = {name: dateutil.tz.gettz(zone) for name, zone in TZINFOS.items()}
+    try:
+        dt = dateutil.parser.parse(date_from_message)
+    except ValueError:
+        dt = dateutil.parser.parse(date_from_message, fuzzy=True)
+    if dt_is_naive(dt):
+        try:
+            dt = dateutil.parser.parse(date_from_message, tzinfos=tzinfos)
+        except ValueError:
+            # strip the unknown zone name, force UTC
+            dt = dateutil.parser.parse(' '.join(
+                date_from_message.split()[:-1])).replace(
+                    tzinfo=dateutil.tz.tzutc()
+                )
+    if dt_is_naive(dt):
+        dt = dt.replace(tzinfo=dateutil.tz.tzutc())
+    return int((dt - EPOCH).total_seconds())
+
+@functools.lru_cache(maxsize=4096)
+def dateEpoch(date_from_message):
+    # most Date headers are RFC 5322 with a numeric zone and parse quickly
+    # with the standard library; zone names and malformed headers still go
+    # through dateutil so their filenames stay the same as before
+    import email.utils
+    if NUMERIC_ZONE.search(date_from_message):
+        try:
+            dt = email.utils.parsedate_to_datetime(date_from_message)
+        except (TypeError, ValueError, IndexError):
+            dt = None
+        if dt is not None and dt_is_naive(dt):
+            # -0000 means UTC with no information about the local zone
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        if dt is not None:
+            return int(dt.timestamp())
+    return dateutilEpoch(date_from_message)
+
+def messageEpoch(parsed_msg, debug, fallback=0):
+    # fallback, e.g. the INTERNALDATE, is for a Date header nothing can
+    # parse; one such message must not stop a whole --copy
+    date_from_message = parsed_msg['date']
+    if debug > 0:
+        print(f'Date: {date_from_message}')
+        print('Subject: {}'.format(parsed_msg['subject']))
+    if date_from_message is None:
+        date_from_message = EPOCHSTR
+    try:
+        return dateEpoch(str(date_from_message))
+    except (ValueError, OverflowError) as e:
+        if debug > 0: print(f'unparseable Date: {date_from_message} ({e})')
+        return fallback
+
+def interactiveDelete(m, mailbox, batch_size, debug):
+    info = selectMailbox(m, mailbox, False, debug)
+    if info is None:
+        return 'mailbox not found'
     message_count = 0
     delete_count = 0
-    for msg_uid in response[0].split():
+    # headers are fetched a batch at a time, as the loop gets to them
+    headers = (header for uid_set in searchRanges(m, debug).batches(batch_size)
+               for header in getHeaders(m, str(uid_set), debug,
+                                        fields='DATE TO FROM SUBJECT'))
+    for (msg_uid, message_id, size, parsed_msg, internaldate) in headers:
         message_count +=1
-        (message_data, message_id) = getMessage(m, msg_uid, debug)
-        parsed_msg = email.message_from_string(message_data)
         print('Date: {}'.format(parsed_msg['date']))
         print('To: {}'.format(parsed_msg['to']))
         print('From: {}'.format(parsed_msg['from']))
@@ -221,7 +950,7 @@ def interactiveDelete(m, mailbox, debug):
         if debug > 1: print(parsed_msg)
         user_input = input('Delete? (y/n/q): ')
         if 'y' == user_input:
-            print(m.uid('STORE', msg_uid, '+FLAGS', '(\\Deleted)'))
+            print(m.uid('STORE', str(msg_uid), '+FLAGS', '(\\Deleted)'))
             delete_count += 1
         if 'q' == user_input:
             break
@@ -234,58 +963,435 @@ def interactiveDelete(m, mailbox, debug):
     m.close()
     return [message_count, delete_count]
 
-def envelopes(m, mailbox, debug):
-    status, response = m.select(mailbox, readonly=True)
-    if debug > 1: print(response)
-    if 'OK' != status:
+def deleteMessages(m, mailbox, criterion, batch_size, debug, dry_run=False):
+    info = selectMailbox(m, mailbox, dry_run, debug)
+    if info is None:
         return 'mailbox not found'
-    status, response = m.uid('search', None, 'ALL')
-    assert('OK' == status)
-    assert(type(response == list))
-    assert(1 == len(response))
+    if debug > 1: print(f'using this search criterion: {criterion}')
+    uids = searchRanges(m, debug, ' '.join(criterion))
+    print(f'{mailbox}: {len(uids)} messages match')
+    if dry_run or not uids:
+        return [len(uids), 0]
+    gmail_metrics.METRICS.progress(mailbox, 0, len(uids))
+    for i, uid_set in enumerate(uids.batches(batch_size)):
+        status, response = m.uid('STORE', str(uid_set), '+FLAGS.SILENT',
+                                 '(\\Deleted)')
+        if debug > 1: print(f'status:{status} response:{response}')
+        assert('OK' == status)
+        gmail_metrics.METRICS.progress(mailbox, min((i + 1) * batch_size,
+                                                    len(uids)), len(uids))
+    # UID EXPUNGE (UIDPLUS) leaves other messages flagged \Deleted alone;
+    # keep the command line within what servers are required to accept
+    uid_set = str(uids)
+    if 'UIDPLUS' not in m.capabilities:
+        status, response = m.expunge()
+        assert('OK' == status)
+        expunge_sets = []
+    elif len(uid_set) <= LINE_LIMIT:
+        expunge_sets = [uid_set]
+    else:
+        expunge_sets = map(str, uids.batches(batch_size))
+    for uid_set in expunge_sets:
+        status, response = m.uid('EXPUNGE', uid_set)
+        if debug > 1: print(f'status:{status}')
+        assert('OK' == status)
+    m.close()
+    return [len(uids), len(uids)]
+
+def envelopes(m, mailbox, batch_size, debug, criterion=None):
+    info = selectMailbox(m, mailbox, True, debug)
+    if info is None:
+        return 'mailbox not found'
+    uids = searchRanges(m, debug, ' '.join(criterion or ['ALL']))
+    gmail_metrics.METRICS.progress(mailbox, 0, len(uids))
+    for i, uid_set in enumerate(uids.batches(batch_size)):
+        status, response = m.uid('FETCH', str(uid_set), '(UID ENVELOPE)')
+        assert('OK' == status)
+        with gmail_metrics.METRICS.timer('parse'):
+            items = parseFetchResponse(response)
+        for item in items:
+            if 'ENVELOPE' in item:
+                print(f'uid:{item["UID"]} envelope:{item["ENVELOPE"]}')
+        gmail_metrics.METRICS.progress(mailbox, min((i + 1) * batch_size,
+                                                    len(uids)), len(uids))
+
+def envelopeString(value):
+    import email.header
+    if value is None:
+        return None
+    if bytes == type(value):
+        value = value.decode('utf-8', 'replace')
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except (ValueError, LookupError):
+        return value
+
+def envelopeAddresses(addresses):
+    # each address is (name adl mailbox host); a NIL host marks a group
+    if list != type(addresses):
+        return None
+    rendered = []
+    for address in addresses:
+        (name, adl, mailbox, host) = [envelopeString(a) for a in address]
+        if host is None:
+            continue
+        rendered.append(f'{name} <{mailbox}@{host}>' if name
+                        else f'{mailbox}@{host}')
+    return ', '.join(rendered)
+
+def internaldateEpoch(internaldate):
+    return int(datetime.datetime.strptime(
+        internaldate.strip(), '%d-%b-%Y %H:%M:%S %z').timestamp())
+
+def indexLabels(item):
+    return json.dumps([envelopeString(label)
+                       for label in item.get('X-GM-LABELS') or []])
+
+def indexRow(mailbox, item):
+    envelope = item['ENVELOPE']
+    return (mailbox, int(item['UID']), int(item['X-GM-MSGID']),
+            int(item['X-GM-THRID']), indexLabels(item),
+            internaldateEpoch(item['INTERNALDATE']),
+            int(item['RFC822.SIZE']),
+            envelopeString(envelope[0]), envelopeString(envelope[1]),
+            *[envelopeAddresses(addresses) for addresses in envelope[2:8]],
+            envelopeString(envelope[8]), envelopeString(envelope[9]))
+
+def refreshLabels(m, mailbox, index, uids, modseq, batch_size, debug):
+    # the labels of messages already indexed: with a HIGHESTMODSEQ from an
+    # earlier run only those of messages changed since, else all of them
+    import gmail_index
+    if modseq is not None:
+        fetches = [(f'1:{uids.last()}', f' (CHANGEDSINCE {modseq})')]
+    else:
+        fetches = [(str(uid_set), '') for uid_set in uids.batches(batch_size)]
+    relabeled = 0
+    for uid_set, modifiers in fetches:
+        status, response = m.uid('FETCH', uid_set,
+                                 '(UID X-GM-LABELS)' + modifiers)
+        if debug > 1: print(f'status:{status} response:{response}')
+        assert('OK' == status)
+        labels = [(indexLabels(item), int(item['UID']))
+                  for item in parseFetchResponse(response)
+                  if 'X-GM-LABELS' in item]
+        gmail_index.updateLabels(index, mailbox, labels)
+        relabeled += len(labels)
+    if debug > 0: print(f'{mailbox}: relabeled:{relabeled}')
+    return relabeled
+
+def indexMessages(m, mailbox, indexFile, batch_size, debug):
+    # ENABLE comes before SELECT; without CONDSTORE the labels of a message
+    # stay as they were when it was first indexed
+    condstore = enableExtension(m, 'CONDSTORE', debug)
+    info = selectMailbox(m, mailbox, True, debug)
+    if info is None:
+        return 'mailbox not found'
+    import gmail_index
+    index = gmail_index.openIndex(indexFile)
+    last_uid = gmail_index.mailboxState(index, mailbox, info['uidvalidity'],
+                                        debug)
+    all_uids = searchRanges(m, debug)
+    pruned = gmail_index.pruneMessages(index, mailbox, all_uids)
+    relabeled = 0
+    condstore = condstore and 'highestmodseq' in info
+    indexed = all_uids.below(last_uid + 1)
+    if condstore and indexed:
+        relabeled = refreshLabels(m, mailbox, index, indexed,
+                                  gmail_index.mailboxModseq(index, mailbox),
+                                  batch_size, debug)
+    uids = all_uids.above(last_uid)
     message_count = 0
-    for msg_uid in response[0].split():
-        message_count +=1
-        status, response = m.uid('FETCH', msg_uid, '(ENVELOPE)')
+    gmail_metrics.METRICS.progress(mailbox, 0, len(uids))
+    for uid_set in uids.batches(batch_size):
+        status, response = m.uid('FETCH', str(uid_set),
+                                 '(UID X-GM-MSGID X-GM-THRID X-GM-LABELS '
+                                 'INTERNALDATE RFC822.SIZE ENVELOPE)')
+        if debug > 1: print(f'status:{status} response:{response}')
         assert('OK' == status)
-        print(response)
+        with gmail_metrics.METRICS.timer('parse'):
+            rows = [indexRow(mailbox, item)
+                    for item in parseFetchResponse(response)
+                    if 'ENVELOPE' in item]
+        message_count += len(rows)
+        last_uid = max([last_uid] + [row[1] for row in rows])
+        with gmail_metrics.METRICS.timer('write'):
+            gmail_index.addMessages(index, mailbox, rows, last_uid)
+        gmail_metrics.METRICS.count('messages_total', len(rows))
+        if debug > 0: print(f'{mailbox}: indexed:{message_count}/{len(uids)}')
+        gmail_metrics.METRICS.progress(mailbox, message_count, len(uids))
+    if condstore:
+        # every message is indexed with the labels it had at this modseq
+        gmail_index.updateLabels(index, mailbox, [], info['highestmodseq'])
+    index.close()
+    return [message_count, pruned, relabeled]
 
-def flags(m, mailbox, debug):
-    status, response = m.select(mailbox, readonly=True)
-    if debug > 1: print(response)
-    if 'OK' != status:
+def offlineQueries(args):
+    import gmail_index
+    index = gmail_index.openIndex(args.indexFile)
+    where, params = gmail_index.searchCriteria(args)
+    if args.debug > 0: print(f'using this index criterion: {where} {params}')
+    if args.list:
+        mailboxes = gmail_index.listMailboxes(index)
+    else:
+        mailboxes = [args.mailbox]
+    for mailbox in mailboxes:
+        message_count = gmail_index.countMessages(index, mailbox, where,
+                                                  params)
+        print(f'{mailbox}:{message_count}')
+    index.close()
+
+def enableExtension(m, extension, debug):
+    if extension not in m.capabilities or 'ENABLE' not in m.capabilities:
+        return False
+    if 'SELECTED' == m.state:
+        # ENABLE is only allowed before SELECT, e.g. --copy --index
+        if 'UNSELECT' in m.capabilities:
+            m.unselect()
+        else:
+            m.close()
+    status, response = m.enable(extension)
+    enabled = b' '.join(m.untagged_responses.pop('ENABLED', [b'']))
+    if debug > 1: print(f'status:{status} enabled:{enabled}')
+    return 'OK' == status and extension in enabled.decode('utf-8').upper()
+
+def flags(m, mailbox, debug, stateFile=None):
+    if stateFile:
+        return syncFlags(m, mailbox, debug, stateFile)
+    info = selectMailbox(m, mailbox, True, debug)
+    if info is None:
         return 'mailbox not found'
-    status, response = m.uid('search', None, 'ALL')
+    if 0 == info['exists']:
+        return 0
+    status, response = m.uid('FETCH', '1:*', '(UID FLAGS)')
+    if debug > 1: print(f'status:{status} response:{response}')
     assert('OK' == status)
-    assert(type(response == list))
-    assert(1 == len(response))
     message_count = 0
-    for msg_uid in response[0].split():
-        message_count +=1
-        status, response = m.uid('FETCH', msg_uid, '(FLAGS)')
+    for item in parseFetchResponse(response):
+        if 'UID' in item and 'FLAGS' in item:
+            message_count += 1
+            print(f'uid:{item["UID"]} flags:({" ".join(item["FLAGS"])})')
+    return message_count
+
+def sideStateFile(stateFile, kind):
+    # state.json -> state.flags.json; the flags or labels of every message
+    # make a big file, keep them out of the one --copy rewrites after every
+    # batch
+    root, ext = os.path.splitext(stateFile)
+    return f'{root}.{kind}{ext}'
+
+def loadFlagState(stateFile, mailbox):
+    state = loadState(sideStateFile(stateFile, 'flags'))
+    if mailbox not in state:
+        # flags kept in the state file itself by earlier versions move over
+        old_state = loadState(stateFile)
+        old = old_state.get(mailbox, {})
+        if 'flags' in old:
+            state[mailbox] = {'uidvalidity': old.get('uidvalidity'),
+                              'last_uid': 0, 'flags': old.pop('flags')}
+            if 'highestmodseq' in old:
+                state[mailbox]['highestmodseq'] = old.pop('highestmodseq')
+            saveState(sideStateFile(stateFile, 'flags'), state)
+            saveState(stateFile, old_state)
+    return state
+
+def syncFlags(m, mailbox, debug, stateFile):
+    # ENABLE QRESYNC implies CONDSTORE; Gmail only offers CONDSTORE, in
+    # which case deletions are found by comparing against UID SEARCH ALL
+    qresync = enableExtension(m, 'QRESYNC', debug)
+    condstore = qresync or enableExtension(m, 'CONDSTORE', debug)
+    info = selectMailbox(m, mailbox, True, debug)
+    if info is None:
+        return 'mailbox not found'
+    state = loadFlagState(stateFile, mailbox)
+    mailbox_state = mailboxState(state, mailbox, info, debug)
+    known = mailbox_state.setdefault('flags', {})
+    modseq = mailbox_state.get('highestmodseq')
+    delta = condstore and modseq is not None and 'highestmodseq' in info
+    fetched = {}
+    vanished = set()
+    if 0 < info['exists']:
+        modifiers = ''
+        if delta:
+            modifiers = f' (CHANGEDSINCE {modseq}'
+            modifiers += ' VANISHED)' if qresync else ')'
+        status, response = m.uid('FETCH', '1:*', '(UID FLAGS)' + modifiers)
+        if debug > 1: print(f'status:{status} response:{response}')
         assert('OK' == status)
-        print(response)
+        for item in parseFetchResponse(response):
+            if 'UID' in item and 'FLAGS' in item:
+                fetched[item['UID']] = sorted(item['FLAGS'])
+        for vanished_data in m.untagged_responses.pop('VANISHED', []):
+            gone = UidRanges.parse(vanished_data.decode('utf-8').split()[-1])
+            vanished.update(uid for uid in known if int(uid) in gone)
+    if not delta:
+        vanished.update(set(known) - set(fetched))
+    elif not qresync:
+        present = searchRanges(m, debug)
+        vanished.update(uid for uid in known if int(uid) not in present)
+    changed = 0
+    for uid, uid_flags in sorted(fetched.items(), key=lambda i: int(i[0])):
+        if known.get(uid) != uid_flags:
+            changed += 1
+            known[uid] = uid_flags
+            print(f'uid:{uid} flags:({" ".join(uid_flags)})')
+    vanished &= set(known)
+    for uid in sorted(vanished, key=int):
+        del known[uid]
+        print(f'uid:{uid} vanished')
+    if condstore and 'highestmodseq' in info:
+        mailbox_state['highestmodseq'] = info['highestmodseq']
+    saveState(sideStateFile(stateFile, 'flags'), state)
+    return [changed, len(vanished)]
+
+def filenameEpoch(filename):
+    # <epoch>.<X-GM-MSGID>.gmail as written by --copy, or <epoch>.<unique>
+    # as in any Maildir
+    prefix = os.path.basename(filename).split('.')[0]
+    return int(prefix) if prefix.isdigit() else None
+
+def filenameMessageId(filename):
+    parts = os.path.basename(filename).split('.')
+    if 3 == len(parts) and 'gmail' == parts[2] and parts[1].isdigit():
+        return parts[1]
+    return None
 
 def append(m, mailbox, filename, debug):
     with open(filename, 'rb') as f:
         message_data = f.read()
-    date_from_message = email.message_from_string(message_data)['date']
-    if None == date_from_message:
-        date_time = imaplib.Time2Internaldate(time.time())
-    else:
-        date_time = imaplib.Time2Internaldate(
-            (dateutil.parser.parse(date_from_message) - EPOCH).total_seconds())
-    if debug > 1: print(date_from_message, date_time)
-    status, response = m.append(mailbox, '', date_time, message_data)
+    epoch = filenameEpoch(filename)
+    if epoch is None:
+        date_from_message = email.message_from_bytes(message_data)['date']
+        if None == date_from_message:
+            epoch = time.time()
+        else:
+            epoch = dateEpoch(str(date_from_message))
+    date_time = imaplib.Time2Internaldate(epoch)
+    if debug > 1: print(filename, date_time)
+    status, response = m.append(f'"{mailbox}"', '', date_time, message_data)
+    if debug > 1: print(f'status:{status} response:{response}')
+    assert('OK' == status)
+    return len(message_data)
+
+def messageFiles(directory):
+    # *.gmail files anywhere below directory, plus everything in the cur
+    # and new folders of a Maildir; tmp holds partial deliveries
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = sorted(d for d in dirnames if 'tmp' != d)
+        maildir = os.path.basename(dirpath) in ('cur', 'new')
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            if maildir or filename.endswith('.gmail'):
+                yield os.path.join(dirpath, filename)
+
+def headerMessageId(header_data):
+    message_id = email.message_from_bytes(header_data or b'')['message-id']
+    return str(message_id).strip() if message_id else None
+
+def fileMessageId(filename):
+    # the Message-ID header, reading no further than the end of the headers
+    lines = []
+    with open(filename, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                break
+            lines.append(line)
+    return headerMessageId(b''.join(lines))
+
+def existingMessageIds(m, mailbox, batch_size, debug):
+    # the X-GM-MSGIDs and Message-ID headers already in mailbox; APPEND
+    # gives a restored message a new X-GM-MSGID, so only the Message-ID
+    # tells that an earlier, interrupted run already uploaded it
+    info = selectMailbox(m, mailbox, True, debug)
+    if info is None:
+        return None
+    if 0 == info['exists']:
+        m.close()
+        return set(), set()
+    gmail_ids = set()
+    message_ids = set()
+    for uid_set in searchRanges(m, debug).batches(batch_size):
+        status, response = m.uid('FETCH', str(uid_set), '(UID X-GM-MSGID '
+                                 'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+        assert('OK' == status)
+        for item in parseFetchResponse(response):
+            if 'X-GM-MSGID' in item:
+                gmail_ids.add(item['X-GM-MSGID'])
+            header_data = [value for key, value in item.items()
+                           if key.startswith('BODY[HEADER.FIELDS')]
+            message_id = headerMessageId((header_data or [b''])[0])
+            if message_id:
+                message_ids.add(message_id)
+    m.close()
+    return gmail_ids, message_ids
+
+def appendDirectory(m, mailbox, directory, debug, workers=1, login=None,
+                    batch_size=500):
+    existing = existingMessageIds(m, mailbox, batch_size, debug)
+    if existing is None:
+        return 'mailbox not found'
+    (gmail_ids, message_ids) = existing
+    files = []
+    skip_count = 0
+    for filename in messageFiles(directory):
+        if (filenameMessageId(filename) in gmail_ids or
+                (message_ids and fileMessageId(filename) in message_ids)):
+            skip_count += 1
+        else:
+            files.append(filename)
+    if debug > 0: print(f'{mailbox}: to append:{len(files)} '
+                        f'skipped:{skip_count}')
+    # imaplib waits for the continuation of every APPEND literal, so the
+    # way to overlap uploads is more connections
+    results = runJobs(m, files, lambda w, f: append(w, mailbox, f, debug),
+                      debug, workers, login)
+    append_count = 0
+    byte_count = 0
+    failed = []
+    start = time.time()
+    gmail_metrics.METRICS.progress(mailbox, 0, len(files))
+    for filename, size, error in results:
+        if error is not None:
+            print(f'{mailbox}: failed file:{filename} error:{error}')
+            failed.append(filename)
+            continue
+        append_count += 1
+        byte_count += size
+        gmail_metrics.METRICS.count('messages_total')
+        gmail_metrics.METRICS.count('message_bytes_total', size)
+        if debug > 0: print(f'{mailbox}: appended:{append_count}/{len(files)}')
+        gmail_metrics.METRICS.progress(mailbox, append_count + len(failed),
+                                       len(files))
+    elapsed = max(time.time() - start, 1e-6)
+    if debug > 0: print(f'{mailbox}: {append_count / elapsed:.1f} messages/s '
+                        f'{byte_count / elapsed:.0f} bytes/s')
+    return [append_count, skip_count, len(failed)]
 
-def gmailLogout(m, debug):
+def gmailLogout(m, debug=0):
     if debug > 0: print('about to log out')
     m.logout()
     if debug > 0: print('just logged out')
 
-if '__main__' == __name__:
-    args = parseArgs()
-    m = gmailLogin(args.username, args.tokenFile, debug=args.debug)
+def copySink(args):
+    if 'pack' == args.format:
+        import gmail_pack
+        try:
+            return gmail_pack.PackWriter('.', args.packCompression,
+                                         args.packSize)
+        except BlockingIOError:
+            sys.exit('--format pack: another run is writing to this '
+                     'directory')
+    return FileSink()
+
+def main(argv=None):
+    args = parseArgs(argv)
+    gmail_metrics.METRICS.enabled = bool(args.progress or args.metrics)
+    gmail_metrics.METRICS.show_progress = args.progress
+    if args.offline:
+        offlineQueries(args)
+        sys.exit(0)
+    m = gmailLogin(args.username, args.tokenFile, debug=args.debug,
+                   compress=args.compress)
     criterion = []
     if args.before:
         criterion.append(searchDate('before', args.before, debug=args.debug))
@@ -303,26 +1409,95 @@ if '__main__' == __name__:
         criterion.append(searchString('to', args.to, debug=args.debug))
     if args.subject:
         criterion.append(searchString('subject', args.subject, debug=args.debug))
+    if args.gmailQuery:
+        # a quoted string is 7-bit unless the server has UTF8=ACCEPT on
+        if (not args.gmailQuery.isascii() and
+                not enableExtension(m, 'UTF8=ACCEPT', args.debug)):
+            sys.exit('--gmailQuery: non-ASCII queries need UTF8=ACCEPT')
+        criterion.append(searchRaw(args.gmailQuery, debug=args.debug))
     if args.list:
         mailboxes = listMailboxes(m, debug=args.debug)
-        for mailbox in mailboxes:
-            message_count = countMessages(m, mailbox, criterion,
-                                          debug=args.debug)
+        login = functools.partial(gmailLogin, args.username, args.tokenFile,
+                                  debug=args.debug, compress=args.compress)
+        for mailbox, message_count in countMailboxes(
+                m, mailboxes, criterion, debug=args.debug,
+                workers=args.workers, login=login):
             print(f'{mailbox}:{message_count}')
     if args.count:
         message_count = countMessages(m, args.mailbox, criterion,
                                       debug=args.debug)
         print(f'{args.mailbox}:{message_count}')
     if args.copy:
-        copyMessages(m, args.mailbox, debug=args.debug)
+        login = functools.partial(gmailLogin, args.username, args.tokenFile,
+                                  debug=args.debug, compress=args.compress)
+        sink = copySink(args)
+        message_count = copyMessages(m, args.mailbox, args.batchSize,
+                                     debug=args.debug,
+                                     stateFile=args.stateFile,
+                                     workers=args.workers, login=login,
+                                     chunk_size=args.chunkSize, sink=sink)
+        sink.close()
+        print(f'{args.mailbox}:{message_count}')
+    if args.backup:
+        login = functools.partial(gmailLogin, args.username, args.tokenFile,
+                                  debug=args.debug, compress=args.compress)
+        sink = copySink(args)
+        result = backup(m, args.batchSize, debug=args.debug,
+                        stateFile=args.stateFile, workers=args.workers,
+                        login=login, chunk_size=args.chunkSize, sink=sink,
+                        manifest=args.manifest, linkDir=args.labelLinks)
+        sink.close()
+        if list == type(result):
+            print(f'copied:{result[0]} messages:{result[1]} '
+                  f'labels:{result[2]} links:{result[3]}')
+        else:
+            print(f'All Mail: {result}')
     if args.interactiveDelete:
         (message_count, delete_count) = interactiveDelete(
-            m, args.mailbox, debug=args.debug)
+            m, args.mailbox, args.batchSize, debug=args.debug)
         print(f'messages processed:{message_count} deleted:{delete_count}')
+    if args.delete:
+        result = deleteMessages(m, args.mailbox, criterion, args.batchSize,
+                                debug=args.debug, dry_run=args.dryRun)
+        if list == type(result):
+            print(f'messages matched:{result[0]} deleted:{result[1]}')
+        else:
+            print(f'{args.mailbox}: {result}')
     if args.envelopes:
-        envelopes(m, args.mailbox, debug=args.debug)
+        envelopes(m, args.mailbox, args.batchSize, debug=args.debug,
+                  criterion=criterion)
+    if args.index:
+        result = indexMessages(m, args.mailbox, args.indexFile,
+                               args.batchSize, debug=args.debug)
+        if list == type(result):
+            print(f'{args.mailbox}: indexed:{result[0]} pruned:{result[1]} '
+                  f'relabeled:{result[2]}')
+        else:
+            print(f'{args.mailbox}: {result}')
     if args.flags:
-        flags(m, args.mailbox, debug=args.debug)
+        result = flags(m, args.mailbox, debug=args.debug,
+                       stateFile=args.stateFile)
+        if list == type(result):
+            print(f'flags changed:{result[0]} vanished:{result[1]}')
+        elif str == type(result):
+            print(f'{args.mailbox}: {result}')
     if args.append:
         append(m, args.mailbox, args.append, debug=args.debug)
+    if args.appendDir:
+        login = functools.partial(gmailLogin, args.username, args.tokenFile,
+                                  debug=args.debug, compress=args.compress)
+        result = appendDirectory(
+            m, args.mailbox, args.appendDir, debug=args.debug,
+            workers=args.workers, login=login, batch_size=args.batchSize)
+        if list == type(result):
+            print(f'appended:{result[0]} skipped:{result[1]} '
+                  f'failed:{result[2]}')
+        else:
+            print(f'{args.mailbox}: {result}')
     gmailLogout(m, debug=args.debug)
+    gmail_metrics.METRICS.progressDone()
+    if args.metrics:
+        gmail_metrics.METRICS.write(args.metrics)
+
+if '__main__' == __name__:
+    main()
@@ -3,28 +3,74 @@
 # based on the gmail API sample python docs found here:
 # https://developers.google.com/gmail/api/v1/reference/users/messages/send
 
+# googleapiclient takes a couple of hundred milliseconds to import, so it
+# is imported by the functions that talk to the API
+
 import argparse
-import httplib2
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+import gmail_lib
 import base64
+import email.errors
+import io
 import os
 import mimetypes
-from email.mime.audio import MIMEAudio
+import random
+import sys
+import tempfile
+import time
+import uuid
 from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
 
-def create_message(sender, to, subject, message_text, attachment_paths,
-                   verbose=0):
-# sender: email address of the sender
-# to: list of receiver email addresses
-# subject: The subject of the email message
-# message_text: The text of the email message
-# attachment_paths: The path[s] of the file[s] to be attached
+DISCOVERY_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'gmailcli')
+DISCOVERY_URL = 'https://gmail.googleapis.com/$discovery/rest?version=v1'
+# the API accepts up to 100 calls per batch, Gmail advises 50 to stay clear
+# of the per-user rate limits
+BATCH_SIZE = 50
+MAX_BATCH_SIZE = 100
+ENCODE_CHUNK = 57 * 1024
+# messages up to SPOOL_SIZE stay in memory, bigger ones go to a temporary
+# file; uploads go out UPLOAD_CHUNK bytes at a time
+SPOOL_SIZE = 1024 * 1024
+UPLOAD_CHUNK = 4 * 1024 * 1024
 
+def attachment_part(attachment_path, placeholder, verbose=0):
+    content_type, encoding = mimetypes.guess_type(attachment_path)
+    if content_type is None or encoding is not None:
+        content_type = 'application/octet-stream'
+    main_type, sub_type = content_type.split('/', 1)
+    if verbose > 0:
+        print('attachment type is: {}'.format(main_type))
+    msg = MIMEBase(main_type, sub_type)
+    if main_type == 'text':
+        msg.set_param('charset', 'utf-8')
+    del msg['MIME-Version']
+    msg['Content-Transfer-Encoding'] = 'base64'
+    msg.add_header('Content-Disposition', 'attachment',
+                   filename=os.path.basename(attachment_path))
+    # the generator writes the placeholder as is, write_message swaps the
+    # encoded file in for it
+    msg.set_payload(placeholder)
+    return msg
+
+def write_base64(f, attachment_path):
+    # 57 input bytes make one 76 character line of base64
+    with open(attachment_path, 'rb') as attachment:
+        chunk = attachment.read(ENCODE_CHUNK)
+        while chunk:
+            next_chunk = attachment.read(ENCODE_CHUNK)
+            encoded = base64.encodebytes(chunk)
+            f.write(encoded if next_chunk else encoded.rstrip(b'\n'))
+            chunk = next_chunk
+
+def write_message(f, sender, to, subject, message_text, attachment_paths,
+                  verbose=0):
+# f: binary file to write the RFC 822 message to
+# other arguments as for create_message
+# attachments are read and encoded a chunk at a time, never all at once
+
+    placeholders = [f'gmailcli-attachment-{uuid.uuid4().hex}'
+                    for attachment_path in attachment_paths]
     if attachment_paths:
         message = MIMEMultipart()
         message.attach(MIMEText(message_text))
@@ -35,68 +81,208 @@ def create_message(sender, to, subject, message_text, attachment_paths,
     message['from'] = sender
     message['subject'] = subject
 
-    for attachment_path in attachment_paths:
-        content_type, encoding = mimetypes.guess_type(attachment_path)
-        if content_type is None or encoding is not None:
-            content_type = 'application/octet-stream'
-        main_type, sub_type = content_type.split('/', 1)
+    for attachment_path, placeholder in zip(attachment_paths, placeholders):
+        message.attach(attachment_part(attachment_path, placeholder,
+                                       verbose))
+
+    skeleton = message.as_bytes()
+    for attachment_path, placeholder in zip(attachment_paths, placeholders):
+        (head, skeleton) = skeleton.split(placeholder.encode('ascii'), 1)
+        f.write(head)
+        write_base64(f, attachment_path)
+    f.write(skeleton)
+
+def create_message(sender, to, subject, message_text, attachment_paths,
+                   verbose=0):
+# sender: email address of the sender
+# to: list of receiver email addresses
+# subject: The subject of the email message
+# message_text: The text of the email message
+# attachment_paths: The path[s] of the file[s] to be attached
+
+    f = io.BytesIO()
+    write_message(f, sender, to, subject, message_text, attachment_paths,
+                  verbose)
+    return {'raw': base64.urlsafe_b64encode(f.getvalue()).decode()}
+
+def send_message(gmail_service, sender, to, subject, message_text,
+                 attachment_paths, verbose=0):
+# like sending create_message's body, but the message is spooled to a
+# temporary file and sent with a resumable media upload, so memory use
+# does not depend on the size of the attachments; a message that stays
+# below SPOOL_SIZE goes out in a single request, a resumable upload costs
+# an extra round trip
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as f:
+        write_message(f, sender, to, subject, message_text,
+                      attachment_paths, verbose)
+        size = f.tell()
+        f.seek(0)
+        if size < SPOOL_SIZE:
+            raw = base64.urlsafe_b64encode(f.read()).decode()
+            return gmail_service.users().messages().send(
+                userId='me', body={'raw': raw}).execute()
+        from googleapiclient.http import MediaIoBaseUpload
+        media = MediaIoBaseUpload(f, mimetype='message/rfc822',
+                                  chunksize=UPLOAD_CHUNK, resumable=True)
+        request = gmail_service.users().messages().send(userId='me',
+                                                        body={},
+                                                        media_body=media)
+        response = None
+        while response is None:
+            status, response = request.next_chunk()
+            if status and verbose > 0:
+                print(f'uploaded {int(status.progress() * 100)}%')
+    return response
+
+def discovery_document(cache_dir=DISCOVERY_CACHE, verbose=0):
+    path = os.path.join(cache_dir, 'gmail.v1.json')
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return f.read()
+    # recent googleapiclient releases ship the document, older ones fetch it
+    from googleapiclient import discovery_cache
+    document = discovery_cache.get_static_doc('gmail', 'v1')
+    if document is None:
+        import httplib2
         if verbose > 0:
-            print('attachment type is: {}'.format(main_type))
-        with open(attachment_path, 'rb') as f:
-            if main_type == 'text':
-                msg = MIMEText(f.read(), _subtype=sub_type, _charset='utf-8')
-                if verbose > 1:
-                    print('Text')
-            elif main_type == 'image':
-                msg = MIMEImage(f.read(), _subtype=sub_type)
-                if verbose > 1:
-                    print('Image')
-            elif main_type == 'audio':
-                msg = MIMEAudio(f.read(), _subtype=sub_type)
-                if verbose > 1:
-                    print('Audio')
-            elif main_type == 'application':
-                msg = MIMEApplication(f.read(), _subtype=sub_type)
-                if verbose > 1:
-                    print('Application')
-            else:
-                msg = MIMEBase(main_type, sub_type)
-                if verbose > 1:
-                    print('Base')
-                msg.set_payload(f.read())
-
-        msg.add_header('Content-Disposition', 'attachment',
-                       filename=os.path.basename(attachment_path))
-        message.attach(msg)
-
-    return {'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
+            print('fetching discovery document')
+        response, content = httplib2.Http().request(DISCOVERY_URL)
+        assert(200 == response.status)
+        document = content.decode('utf-8')
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(document)
+    os.replace(f'{path}.tmp', path)
+    return document
 
 def get_gmail_service(tokenFile, verbose=0):
-    credentials = Credentials.from_authorized_user_file(tokenFile)
-    return build('gmail', 'v1', credentials=credentials)
+    from googleapiclient.discovery import build_from_document
+    credentials = gmail_lib.loadCredentials(tokenFile, verbose)
+    return build_from_document(discovery_document(verbose=verbose),
+                               credentials=credentials)
 
-if '__main__' == __name__:
+def retryable(exception):
+    # rate limiting and server errors go away if you wait
+    from googleapiclient.errors import HttpError
+    return (isinstance(exception, HttpError) and
+            (429 == exception.resp.status or 500 <= exception.resp.status))
+
+def send_batch(gmail_service, messages, verbose=0, batch_size=BATCH_SIZE,
+               retries=5):
+# messages: list of (message number, message body from create_message)
+# returns the number sent and a list of (message number, exception)
+    from googleapiclient.errors import HttpError
+    pending = list(messages)
+    sent = 0
+    failed = []
+    for attempt in range(retries + 1):
+        retry = []
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            results = {}
+            def callback(request_id, response, exception):
+                results[request_id] = exception
+            batch = gmail_service.new_batch_http_request(callback=callback)
+            for number, body in chunk:
+                batch.add(gmail_service.users().messages().send(
+                    userId='me', body=body), request_id=str(number))
+            try:
+                batch.execute()
+            except HttpError as e:
+                # the batch request itself failed, none of it was sent
+                results = {str(number): e for number, body in chunk}
+            for number, body in chunk:
+                exception = results.get(str(number))
+                if exception is None:
+                    sent += 1
+                elif retryable(exception) and attempt < retries:
+                    retry.append((number, body))
+                else:
+                    failed.append((number, exception))
+        if not retry:
+            break
+        pending = retry
+        delay = min(2 ** attempt, 64) + random.random()
+        if verbose > 0:
+            print(f'retrying {len(retry)} messages in {delay:.1f}s')
+        time.sleep(delay)
+    return sent, failed
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--tokenFile', required=True,
                         help='file containing OAuth token in JSON format')
-    parser.add_argument('-r', '--recipients', required=True, nargs='+',
+    parser.add_argument('-r', '--recipients', nargs='+',
                         help='list of recipients')
-    parser.add_argument('-s', '--subject', required=True,
+    parser.add_argument('-s', '--subject',
                         help='subject of email message')
-    parser.add_argument('-b', '--body', required=True,
+    parser.add_argument('-b', '--body',
                         help='body of email message')
     parser.add_argument('-a', '--attachments', nargs='*', default=[],
                         help='list of attachment paths')
+    parser.add_argument('--batch',
+                        help='send every message in this JSON lines file '
+                        '(- for stdin), one {"to", "subject", "body"} '
+                        'per line')
+    parser.add_argument('--batchSize', type=int, default=BATCH_SIZE,
+                        help=f'messages per HTTP batch request, at most '
+                        f'{MAX_BATCH_SIZE}')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='be verbose')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.batch and not (args.recipients and args.subject and
+                               args.body is not None):
+        parser.error('-r/--recipients, -s/--subject and -b/--body are '
+                     'required without --batch')
+    if not 0 < args.batchSize <= MAX_BATCH_SIZE:
+        parser.error(f'--batchSize must be between 1 and {MAX_BATCH_SIZE}')
 
     gmail_service = get_gmail_service(args.tokenFile, args.verbose)
 
-    msg = create_message('me', args.recipients, args.subject, args.body,
-                         args.attachments, args.verbose)
-    if args.verbose > 1:
-        print(msg)
-    res = gmail_service.users().messages().send(userId='me', body=msg).execute()
+    if args.batch:
+        # build and send one --batchSize chunk at a time, the whole merge
+        # with its attachments never has to fit in memory; a bad line or a
+        # missing attachment fails that message alone
+        start = time.time()
+        sent = 0
+        failed = []
+        chunk = []
+        for number, line in enumerate(gmail_lib.readBatch(args.batch), 1):
+            error = gmail_lib.checkMessage(line)
+            if error is None:
+                to = line['to']
+                if str == type(to):
+                    to = [address.strip() for address in to.split(',')]
+                try:
+                    chunk.append((number, create_message(
+                        'me', to, line['subject'], line['body'],
+                        line.get('attachments', []), args.verbose)))
+                except (OSError, ValueError, email.errors.MessageError) as e:
+                    error = e
+            if error is not None:
+                failed.append((number, error))
+            if args.batchSize <= len(chunk):
+                chunk_sent, chunk_failed = send_batch(
+                    gmail_service, chunk, args.verbose, args.batchSize)
+                sent += chunk_sent
+                failed.extend(chunk_failed)
+                chunk = []
+        chunk_sent, chunk_failed = send_batch(gmail_service, chunk,
+                                              args.verbose, args.batchSize)
+        sent += chunk_sent
+        failed.extend(chunk_failed)
+        for number, exception in sorted(failed, key=lambda f: f[0]):
+            print(f'message:{number} error:{exception}')
+        elapsed = max(time.time() - start, 1e-6)
+        print(f'sent:{sent} failed:{len(failed)} '
+              f'{sent / elapsed:.1f} messages/s')
+        sys.exit(1 if failed else 0)
+
+    res = send_message(gmail_service, 'me', args.recipients, args.subject,
+                       args.body, args.attachments, args.verbose)
     if args.verbose > 0:
         print(res)
+
+if '__main__' == __name__:
+    main()
@@ -2,13 +2,16 @@
 
 import argparse
 import base64
+import functools
 import os
 import sys
 import smtplib
-from gmail_lib import refreshToken
-from google.oauth2.credentials import Credentials
+import threading
+import time
+import gmail_lib
+from email.message import EmailMessage
 
-def parseArgs():
+def parseArgs(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='count', default=0,
                         help='increase debug verbosity')
@@ -16,13 +19,26 @@ def parseArgs():
                         help='SMTP username')
     parser.add_argument('-t', '--tokenFile', default=None,
                         help='OAuth token file')
-    parser.add_argument('-r', '--recipients', required=True,
+    parser.add_argument('-r', '--recipients',
                         help='recipient address[es], separated by commas')
-    parser.add_argument('-s', '--subject', required=True,
+    parser.add_argument('-s', '--subject',
                         help='email subject')
-    parser.add_argument('-b', '--body', required=True,
+    parser.add_argument('-b', '--body',
                         help='message body')
-    args = parser.parse_args()
+    parser.add_argument('--batch',
+                        help='send every message in this JSON lines file '
+                        '(- for stdin), one {"to", "subject", "body"} '
+                        'per line')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='number of SMTP sessions for --batch')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='most messages per second for --batch, 0 for '
+                        'no limit')
+    args = parser.parse_args(argv)
+    if not args.batch and not (args.recipients and args.subject and
+                               args.body is not None):
+        parser.error('-r/--recipients, -s/--subject and -b/--body are '
+                     'required without --batch')
     return args
 
 def gmailLogin(username, tokenFile=None, debug=0):
@@ -31,13 +47,7 @@ def gmailLogin(username, tokenFile=None, debug=0):
         print('about to log in')
         m.set_debuglevel(debug) # setting to 4 seems quite verbose
     if tokenFile:
-        credentials = Credentials.from_authorized_user_file(tokenFile)
-        if credentials.expired:
-            if debug > 0: print('access token expired, refreshing')
-            refreshToken(tokenFile, credentials)
-        auth_string = 'user=%s\1auth=Bearer %s\1\1' % (username,
-                                                       credentials.token)
-        if debug > 1: print(auth_string)
+        auth_string = gmail_lib.authString(username, tokenFile, debug)
         m.ehlo()
         m.docmd('AUTH', 'XOAUTH2 ' + base64.b64encode(bytes(
             auth_string, 'utf-8')).decode('utf-8'))
@@ -55,13 +65,103 @@ def gmailLogout(m, debug=0):
     m.quit()
     if debug > 0: print('just logged out')
 
+def buildMessage(fromaddr, toaddrs, subject, body):
+    msg = EmailMessage()
+    msg['From'] = fromaddr
+    msg['To'] = toaddrs
+    msg['Subject'] = subject
+    msg.set_content(body)
+    return msg
+
 def gmailSend(m, fromaddr, toaddrs, subject, body, debug=0):
-    msg = 'From: {}\r\nTo: {} \r\nSubject: {}\r\n\r\n{}'.format(
-        fromaddr, toaddrs, subject, body)
-    m.sendmail(fromaddr, toaddrs, msg)
+    msg = buildMessage(fromaddr, toaddrs, subject, body)
+    if debug > 1: print(msg)
+    m.send_message(msg)
 
-if '__main__' == __name__:
-    args = parseArgs()
+def rateLimiter(rate):
+    # hands out evenly spaced send slots, shared by every session
+    lock = threading.Lock()
+    next_slot = [time.monotonic()]
+    def wait():
+        if not rate:
+            return
+        with lock:
+            now = time.monotonic()
+            slot = max(next_slot[0], now)
+            next_slot[0] = slot + 1 / rate
+        time.sleep(max(0, slot - now))
+    return wait
+
+def transient(e):
+    # dropped sessions and 4xx replies are worth another try on a new
+    # session, 5xx replies (bad recipient, message refused) are not
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, (smtplib.SMTPServerDisconnected, OSError))
+
+def sendBatch(login, fromaddr, messages, debug=0, sessions=1, rate=0,
+              retries=3):
+    import concurrent.futures
+    pool = gmail_lib.SessionPool(login, functools.partial(gmailLogout,
+                                                          debug=debug),
+                                 sessions, check=lambda m: m.noop(),
+                                 max_idle=30)
+    wait = rateLimiter(rate)
+    def send(message):
+        error = gmail_lib.checkMessage(message)
+        if error is not None:
+            return error
+        try: # e.g. a line break in the subject
+            msg = buildMessage(fromaddr, message['to'], message['subject'],
+                               message['body'])
+        except (ValueError, TypeError) as e:
+            return e
+        if debug > 1: print(msg)
+        for attempt in range(retries + 1):
+            wait()
+            try:
+                with pool.session() as m:
+                    m.send_message(msg)
+                return None
+            except (smtplib.SMTPException, OSError) as e:
+                if debug > 0: print(f'attempt:{attempt} error:{e}')
+                if attempt == retries or not transient(e):
+                    return e
+    sent_count = 0
+    failed = []
+    start = time.monotonic()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=sessions)
+    try:
+        futures = {executor.submit(send, message): number
+                   for number, message in enumerate(messages, 1)}
+        for future in concurrent.futures.as_completed(futures):
+            error = future.result()
+            if error is None:
+                sent_count += 1
+            else:
+                print(f'message:{futures[future]} error:{error}')
+                failed.append(futures[future])
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        pool.close()
+    elapsed = max(time.monotonic() - start, 1e-6)
+    return [sent_count, len(failed), sent_count / elapsed]
+
+def main(argv=None):
+    args = parseArgs(argv)
+    if args.batch:
+        login = functools.partial(gmailLogin, args.username, args.tokenFile,
+                                  debug=args.debug)
+        (sent_count, fail_count, rate) = sendBatch(
+            login, args.username, gmail_lib.readBatch(args.batch),
+            debug=args.debug, sessions=args.sessions, rate=args.rate)
+        print(f'sent:{sent_count} failed:{fail_count} '
+              f'{rate:.1f} messages/s')
+        sys.exit(1 if fail_count else 0)
     m = gmailLogin(args.username, args.tokenFile, debug=args.debug)
-    gmailSend(m, args.username, args.recipients, args.subject, args.body)
+    gmailSend(m, args.username, args.recipients, args.subject, args.body,
+              debug=args.debug)
     gmailLogout(m, debug=args.debug)
+
+if '__main__' == __name__:
+    main()
@@ -5,11 +5,11 @@
 import argparse
 import json
 import os.path
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 
 def validateToken(clientSecrets, tokenFile, verbose):
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
     # If modifying these scopes, delete the tokenFile.
     SCOPES = ['https://mail.google.com/']
     creds = None
@@ -37,7 +37,7 @@ def validateToken(clientSecrets, tokenFile, verbose):
             json.dump(json.loads(creds.to_json()), f, indent=4, sort_keys=True)
             f.write('\n')
 
-if '__main__' == __name__:
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='show verbose output')
@@ -45,5 +45,8 @@ if '__main__' == __name__:
                         help='file containing clientSecrets in JSON format')
     parser.add_argument('tokenFile',
                         help='file containing token in JSON format')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     validateToken(args.clientSecrets, args.tokenFile, args.verbose)
+
+if '__main__' == __name__:
+    main()